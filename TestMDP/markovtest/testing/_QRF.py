@@ -14,13 +14,18 @@ warnings.filterwarnings('ignore')
 from numpy.random import seed as rseed 
 from numpy.random import randn # randn(d1,d2) is d1*d2 i.i.d N(0,1)
 import numpy as np
-from numpy import ma
+from scipy import sparse
+from joblib import Parallel, delayed, effective_n_jobs
 from sklearn.ensemble import ExtraTreesRegressor, RandomForestRegressor
+from sklearn.ensemble import _forest
 from sklearn.ensemble._forest import ForestRegressor
 from sklearn.utils import check_array, check_random_state, check_X_y
 from sklearn.tree._classes import BaseDecisionTree
 from sklearn.tree import DecisionTreeRegressor, ExtraTreeRegressor
 import time
+import os
+import json
+import inspect
 now = time.time
 ##########################################################################
 
@@ -43,7 +48,7 @@ def weighted_est(y,uv,cos_sin,weights=None):
         return np.mean(cos_sin(y.dot(uv)),axis = 0)
     return weights.T.dot(cos_sin(y.dot(uv))) # v.T
 
-def generate_sample_indices(random_state, n_samples):
+def generate_sample_indices(random_state, n_samples, n_samples_bootstrap=None, sample_weight=None):
     """
     [Just copied and pasted]
     Generates bootstrap indices for each tree fit.
@@ -57,128 +62,102 @@ def generate_sample_indices(random_state, n_samples):
         by np.random.
 
     n_samples: int
-        Number of samples to generate from each tree.
+        Number of samples to draw from.
+
+    n_samples_bootstrap: int or None
+        Number of samples to generate for each tree (None: n_samples).
+
+    sample_weight: array-like or None
+        If given, the samples are drawn with probabilities proportional to the weights.
 
     Returns
     -------
-    sample_indices: array-like, shape=(n_samples), dtype=np.int32
+    sample_indices: array-like, shape=(n_samples_bootstrap), dtype=np.int32
         Sample indices.
     """
     random_instance = check_random_state(random_state)
-    sample_indices = random_instance.randint(0, n_samples, n_samples)
+    if n_samples_bootstrap is None:
+        n_samples_bootstrap = n_samples
+    if sample_weight is None:
+        sample_indices = random_instance.randint(0, n_samples, n_samples_bootstrap)
+    else:
+        sample_weight = np.asarray(sample_weight, dtype=np.float64)
+        sample_indices = random_instance.choice(n_samples, n_samples_bootstrap, replace=True,
+                                                p=sample_weight / sample_weight.sum())
     return sample_indices
-##########################################################################   
-# QRF <- QBF,QDT
 
-class BaseForestQuantileRegressor(ForestRegressor):
-    def fit(self, X, y):
-        """
-        Build a forest from the training set (X, y).
+# sklearn >= 1.6 draws the bootstrap proportionally to sample_weight, instead of multiplying the counts by it
+_WEIGHTED_BOOTSTRAP = "sample_weight" in inspect.signature(_forest._generate_sample_indices).parameters
 
-        Parameters
-        ----------
-        X : array-like or sparse matrix, shape = [n_samples, n_features]
-            The training input samples. Internally, it will be converted to
-            ``dtype=np.float32`` and if a sparse matrix is provided
-            to a sparse ``csc_matrix``.
+def n_samples_bootstrap(n_samples, max_samples, sample_weight=None):
+    """
+    Size of the per-tree subsample, as sklearn's forests compute it: n_samples (None), max_samples (int),
+    or the fraction max_samples (float) of n_samples (of the total weight, if sklearn samples by weight).
+    """
+    if _WEIGHTED_BOOTSTRAP:
+        return _forest._get_n_samples_bootstrap(n_samples, max_samples, sample_weight)
+    return _forest._get_n_samples_bootstrap(n_samples, max_samples)
+# fitted arrays written by BaseForestQuantileRegressor.save, besides the sparse leaf_weights_ and the prepared tables
+_SAVED_ARRAYS = ("y_train_", "y_train_leaves_", "y_weights_", "node_counts_", "node_offsets_", "node_leaf_", "leaf_mass_",
+                 "tree_feature_", "tree_threshold_", "tree_left_", "tree_right_")
 
-        y : array-like, shape = [n_samples] or [n_samples, n_outputs]
-            The target values (class labels) as integers or strings.
-        Returns
-        -------
-        self : object
-            Returns self.
-        """
-        # apply method requires X to be of dtype np.float32
-        X, y = check_X_y(
-            X, y, accept_sparse="csc", dtype=np.float32, multi_output=1)
-        super(BaseForestQuantileRegressor, self).fit(X, y)
+# batches with n_rows * tree_depth_ up to this are routed through the stacked node arrays rather than sklearn's apply
+# (one vectorized step per level: the flat routing wins below about 5000-10000 row-levels, whatever the tree count)
+_FLAT_APPLY_MAX_WORK = 4000
 
-        self.y_train_ = y
-        self.y_train_leaves_ = -np.ones((self.n_estimators, len(y)), dtype=np.int32)
-        self.y_weights_ = np.zeros_like((self.y_train_leaves_), dtype=np.float32)
-
-        for i, est in enumerate(self.estimators_):
-            bootstrap_indices = generate_sample_indices(est.random_state, len(y))
-            est_weights = np.bincount(bootstrap_indices, minlength=len(y))
-            
-            # Ensure the estimator has y_train_leaves_ attribute
-            # If ForestRegressor built the tree directly, we need to set it up
-            if not hasattr(est, 'y_train_leaves_'):
-                # Tree was built by sklearn, compute y_train_leaves_ from the training data
-                est.y_train_leaves_ = est.tree_.apply(X[bootstrap_indices])
-            
-            y_train_leaves = est.y_train_leaves_
-            for curr_leaf in np.unique(y_train_leaves):
-                y_ind = y_train_leaves == curr_leaf
-                self.y_weights_[i, y_ind] = (
-                    est_weights[y_ind] / np.sum(est_weights[y_ind]))
-
-            self.y_train_leaves_[i, bootstrap_indices] = y_train_leaves[bootstrap_indices]
-        return self
-    
-    def predict(self, X, uv=0): # , cos_sin
-        """
-        Predict cond. char. values for either forward or backward
+def leaf_signatures(leaves):
+    """
+    One hashable/sortable key per row of an (n_samples, n_tree) leaf matrix: the raw bytes of the row.
+    """
+    leaves = np.ascontiguousarray(leaves)
+    return leaves.view(np.dtype((np.void, leaves.dtype.itemsize * leaves.shape[1]))).ravel()
 
-        Parameters
-        ----------
-        X : array-like or sparse matrix of shape = [n_samples, n_features]
-        uv: [B,dim_y]. can be either u or v
-        Returns
-        -------
-        char_est : array of shape = [n_samples,B]
-        """
-        # apply method requires X to be of dtype np.float32
-        X = check_array(X, dtype=np.float32, accept_sparse="csc") # around N * T
-        X_leaves = self.apply(X) # (n_test = N * T, n_tree) 
-        weights = np.zeros((X.shape[0], len(self.y_train_)))# N_test * N_train
-        begin = now()
-        a = now()
-        mask_time = 0
-        sum_time= 0
-        
+def binning_thresholds(X, max_bins=256):
+    """
+    Quantize each feature into at most max_bins bins, computed once and reused by all trees.
+    Features with few distinct values keep them all (thresholds at the midpoints); otherwise the
+    thresholds are the max_bins-quantiles.
 
-        for i, x_leaf in enumerate(X_leaves): # n_test
-            mask = (self.y_train_leaves_ != np.expand_dims(x_leaf, 1))
-            x_weights = ma.masked_array(self.y_weights_, mask)# n_tree * n_train. for each n_test
-            b = now()
-            mask_time += b - a
-            weights[i,:] = x_weights.sum(axis = 0)
-            a = now()
-            sum_time += a - b       
-        # print("prediction iteration:", now()- begin, " with mask:", mask_time, "sum:", sum_time)
-        if uv == 0: # debug. E(X_t|X_t-1). for CV too.
-            return weights.dot(self.y_train_) / np.sum(weights,axis=1)[:,None]
+    Returns
+    -------
+    (n_features, max_bins - 1) thresholds, padded with inf
+    """
+    thresholds = np.full((X.shape[1], max_bins - 1), np.inf)
+    for j in range(X.shape[1]):
+        values = np.unique(X[:, j])
+        if len(values) <= max_bins:
+            cuts = (values[:-1] + values[1:]) / 2
         else:
-            char_est_cos = weights.dot(np.cos(self.y_train_.dot(uv.T))) / np.sum(weights,axis=1)[:,None]
-            char_est_sin = weights.dot(np.sin(self.y_train_.dot(uv.T))) / np.sum(weights,axis=1)[:,None]
-        return char_est_cos, char_est_sin
- 
-class RandomForestQuantileRegressor(BaseForestQuantileRegressor):
+            cuts = np.unique(np.quantile(X[:, j], np.arange(1, max_bins) / max_bins))
+        thresholds[j, :len(cuts)] = cuts
+    return thresholds
+
+def leaf_normalized_weights(leaves, counts, node_totals):
     """
-    Based on BaseForestQuantileRegressor. What is the purpose?
-    
-    The sub-sample size is always the same as the original
-    input sample size but the samples are drawn with replacement if
-    `bootstrap=True` (default).
+    Normalize the bootstrap counts within each leaf, in one pass over the rows.
+
+    Parameters
+    ----------
+    leaves: (n_samples,) leaf (node id) of each training row in one tree
+    counts: (n_samples,) bootstrap count of each training row
+    node_totals: (n_nodes,) sum of the counts in each node, i.e. np.bincount(leaves, weights=counts)
 
+    Returns
+    -------
+    weights: (n_samples,), counts[j] / sum of counts in the leaf of row j
     """
-    def __init__(self,
-                 n_estimators=10,
-                 criterion='squared_error',  # 'mse' deprecated in sklearn 1.3+, use 'squared_error'
-                 max_depth=None,
-                 min_samples_split=2,
-                 min_samples_leaf=1,
-                 min_weight_fraction_leaf=0.0,
-                 max_features='auto',
-                 max_leaf_nodes=None,
-                 bootstrap=True,
-                 oob_score=False,
-                 n_jobs=1,
-                 random_state=None,
-                 verbose=0,
-                 warm_start=False):
+    leaf_totals = node_totals[leaves]
+    return np.divide(counts, leaf_totals, out=np.zeros(len(leaves)), where=leaf_totals > 0)
+##########################################################################   
+# QRF <- QBF,QDT
+
+class BaseForestQuantileRegressor(ForestRegressor):
+    def _init_forest(self, splitter, n_estimators, criterion, max_depth, min_samples_split, min_samples_leaf,
+                     min_weight_fraction_leaf, max_features, max_leaf_nodes, bootstrap, oob_score, n_jobs,
+                     random_state, verbose, warm_start, max_bins, max_samples):
+        """
+        Shared constructor of the quantile forests, whose trees are DecisionTreeQuantileRegressor(splitter=splitter).
+        """
         # Store parameters for tree construction
         self.criterion = criterion
         self.max_depth = max_depth
@@ -187,6 +166,8 @@ class RandomForestQuantileRegressor(BaseForestQuantileRegressor):
         self.min_weight_fraction_leaf = min_weight_fraction_leaf
         self.max_features = max_features
         self.max_leaf_nodes = max_leaf_nodes
+        # histogram mode: quantize the features into <= max_bins bins once per fit (None: exact splits)
+        self.max_bins = max_bins
         
         # Handle sklearn version compatibility for ForestRegressor initialization
         # In sklearn 1.4+, ForestRegressor accepts estimator parameter
@@ -203,6 +184,7 @@ class RandomForestQuantileRegressor(BaseForestQuantileRegressor):
         
         base_tree = DecisionTreeQuantileRegressor(
             criterion=criterion_mapped,
+            splitter=splitter,
             max_depth=max_depth,
             min_samples_split=min_samples_split,
             min_samples_leaf=min_samples_leaf,
@@ -214,7 +196,7 @@ class RandomForestQuantileRegressor(BaseForestQuantileRegressor):
         
         try:
             # Try newer API with estimator parameter (sklearn 1.4+)
-            super(RandomForestQuantileRegressor, self).__init__(
+            super(BaseForestQuantileRegressor, self).__init__(
                 estimator=base_tree,
                 n_estimators=n_estimators,
                 bootstrap=bootstrap,
@@ -226,7 +208,7 @@ class RandomForestQuantileRegressor(BaseForestQuantileRegressor):
         except TypeError:
             # Fallback for older sklearn versions using base_estimator
             try:
-                super(RandomForestQuantileRegressor, self).__init__(
+                super(BaseForestQuantileRegressor, self).__init__(
                     base_estimator=base_tree,
                     n_estimators=n_estimators,
                     bootstrap=bootstrap,
@@ -237,7 +219,7 @@ class RandomForestQuantileRegressor(BaseForestQuantileRegressor):
                     warm_start=warm_start)
             except TypeError:
                 # Last resort: try minimal initialization
-                super(RandomForestQuantileRegressor, self).__init__(
+                super(BaseForestQuantileRegressor, self).__init__(
                     n_estimators=n_estimators,
                     bootstrap=bootstrap,
                     oob_score=oob_score,
@@ -255,6 +237,656 @@ class RandomForestQuantileRegressor(BaseForestQuantileRegressor):
                     'max_features': dt_max_features if 'dt_max_features' in locals() else max_features,
                     'max_leaf_nodes': max_leaf_nodes,
                 }
+        # per-tree subsample size (rows, or groups in fit(..., groups=...)); None: n rows, as in the bootstrap
+        self.max_samples = max_samples
+        # copied onto each tree by _make_estimator, so that set_params (e.g. in a CV search) reaches the trees
+        self.estimator_params = ("max_depth", "min_samples_split", "min_samples_leaf", "min_weight_fraction_leaf",
+                                 "max_leaf_nodes")
+
+    def fit(self, X, y, uv=None, sample_weight=None, groups=None, tol=None, batch_trees=25):
+        """
+        Build a forest from the training set (X, y).
+
+        With max_samples, each tree is grown on a subsample of max_samples rows drawn with replacement,
+        which caps the per-tree cost for very long collections of transitions. With groups (e.g. the trajectory
+        of each row), whole groups are drawn instead, max_samples then counting groups.
+        With tol, n_estimators is only an upper bound: the trees are grown in batches until the out-of-bag
+        estimates stabilize (see ``_grow_adaptive``).
+
+        Parameters
+        ----------
+        X : array-like or sparse matrix, shape = [n_samples, n_features]
+            The training input samples. Internally, it will be converted to
+            ``dtype=np.float32`` and if a sparse matrix is provided
+            to a sparse ``csc_matrix``.
+
+        y : array-like, shape = [n_samples] or [n_samples, n_outputs]
+            The target values (class labels) as integers or strings.
+
+        uv : array-like, shape = [B, n_outputs] or None
+            If given, the per-leaf cos/sin summaries are precomputed (see ``prepare``).
+
+        sample_weight : array-like, shape = [n_samples] or None
+            Sample weights, e.g. the multiplicities of collapsed duplicate rows. They multiply the
+            bootstrap counts, both when growing the trees and in the leaf weights.
+
+        groups : array-like, shape = [n_samples] or None
+            Group label of each row. If given, each tree is grown on a bootstrap sample of the groups.
+
+        tol : float or None
+            If given, stop adding trees once a batch changes the out-of-bag estimates (of cos/sin(y * uv),
+            or of y if uv is None) by less than tol on average. The number of trees used is len(estimators_).
+
+        batch_trees : int
+            Number of trees grown between two convergence checks.
+        Returns
+        -------
+        self : object
+            Returns self.
+        """
+        # apply method requires X to be of dtype np.float32
+        X, y = check_X_y(
+            X, y, accept_sparse="csc", dtype=np.float32, multi_output=1)
+        max_bins = getattr(self, "max_bins", None)
+        self.bin_thresholds_ = None if max_bins is None else binning_thresholds(X, max_bins)
+        X = self._bin(X)
+        if groups is not None:
+            groups = np.unique(groups, return_inverse=True)[1].ravel()
+        if tol is None:
+            self._grow(X, y, sample_weight, groups)
+        else:
+            self._grow_adaptive(X, y, uv, sample_weight, groups, tol, batch_trees)
+
+        self.y_train_ = y
+        self.y_train_leaves_, self.y_weights_, self.node_counts_ = self._tree_tables(
+            self.estimators_, X, sample_weight, groups)
+        self.bootstrap_rate_ = self._bootstrap_rate(len(X), sample_weight, groups)
+        self._build_leaf_index()
+        self._flatten_trees()
+        if uv is not None:
+            self.prepare(uv)
+        return self
+    
+    def _bin(self, X):
+        """
+        Replace the features by their bin codes (as float32), if the forest was fitted with max_bins.
+        """
+        if getattr(self, "bin_thresholds_", None) is None:
+            return X
+        return np.column_stack([np.searchsorted(thresholds, x, side="right")
+                                for thresholds, x in zip(self.bin_thresholds_, X.T)]).astype(np.float32)
+
+    def _grow(self, X, y, sample_weight, groups):
+        """
+        Grow the trees up to n_estimators (only the missing ones under warm_start).
+        With sample_weight, the trees are grown as on the rows repeated by their weights (see ``_weighted_params``).
+        """
+        params = self._weighted_params(len(X), sample_weight)
+        saved = {name: getattr(self, name) for name in params}
+        for name, value in params.items():
+            setattr(self, name, value)
+        try:
+            if groups is None:
+                super(BaseForestQuantileRegressor, self).fit(X, y, sample_weight=sample_weight)
+            else:
+                self._fit_grouped(X, y, sample_weight, groups)
+        finally:
+            for name, value in saved.items():
+                setattr(self, name, value)
+
+    def _max_samples(self, sample_weight=None):
+        """
+        max_samples as used to grow the trees: by default, a bootstrap by weight (sklearn >= 1.6) draws
+        sum(sample_weight) rows (max_samples = 1.0 of the total weight), as many as there are repeated rows.
+        """
+        max_samples = getattr(self, "max_samples", None)
+        if max_samples is None and self.bootstrap and sample_weight is not None and _WEIGHTED_BOOTSTRAP:
+            return 1.0
+        return max_samples
+
+    def _weighted_params(self, n, sample_weight):
+        """
+        Forest parameters overridden while growing the trees with sample_weight (e.g. the multiplicities of collapsed
+        duplicate rows), so that the trees match those grown on the repeated rows: the per-tree sample size counts
+        weight (``_max_samples``), and so does the leaf size, min_samples_leaf being turned into a fraction of
+        the weight of the tree sample (min_weight_fraction_leaf) instead of counting distinct rows.
+        """
+        if sample_weight is None:
+            return {}
+        sample_weight = np.asarray(sample_weight, dtype=np.float64)
+        max_samples = self._max_samples(sample_weight)
+        if self.bootstrap and _WEIGHTED_BOOTSTRAP:
+            tree_weight = n_samples_bootstrap(n, max_samples, sample_weight)
+        else:  # the counts are multiplied by the weights: sum(sample_weight) in expectation (without max_samples)
+            tree_weight = sample_weight.sum()
+        min_samples_leaf = self.min_samples_leaf
+        fraction = min_samples_leaf if isinstance(min_samples_leaf, float) else min_samples_leaf / tree_weight
+        return {"max_samples": max_samples, "min_samples_leaf": 1,
+                "min_weight_fraction_leaf": min(max(self.min_weight_fraction_leaf, fraction), 0.5)}
+
+    def _grow_adaptive(self, X, y, uv, sample_weight, groups, tol, batch_trees):
+        """
+        Grow the forest batch_trees trees at a time (warm start), up to n_estimators trees.
+
+        After each batch, the out-of-bag estimates on a fixed probe set of (at most 500) training rows
+        are updated with the new trees only; the growth stops once their mean absolute change is below tol.
+        To keep the monitoring cheap, only the first 10 directions of uv are tracked.
+        Without bootstrap, every tree is used for every probe row. Sets n_estimators to the number of trees used.
+        """
+        n_max, warm_start = self.n_estimators, self.warm_start
+        n = len(y)
+        probe = np.linspace(0, n - 1, min(500, n)).astype(int)
+        if uv is None:
+            targets = y.reshape(n, -1)
+        else:
+            temp = y.dot(np.asarray(uv)[:10].T)
+            targets = np.hstack([np.cos(temp), np.sin(temp)])
+        est = np.zeros((len(probe), targets.shape[1]))
+        mass = np.zeros(len(probe))
+        previous = None
+        n_trees = 0
+        try:
+            while n_trees < n_max:
+                self.n_estimators = min(n_trees + batch_trees, n_max)
+                self._grow(X, y, sample_weight, groups)
+                self.warm_start = True
+                for tree in self.estimators_[n_trees:]:
+                    self._oob_update(tree, X, targets, probe, sample_weight, groups, est, mass)
+                n_trees = len(self.estimators_)
+                current = np.full(est.shape, np.nan)
+                current[mass > 0] = est[mass > 0] / mass[mass > 0, None]
+                if previous is not None:
+                    both = ~np.isnan(previous[:, 0]) & ~np.isnan(current[:, 0])
+                    if both.any() and np.abs(current[both] - previous[both]).mean() < tol:
+                        break
+                previous = current
+        finally:
+            self.warm_start = warm_start
+        self.n_estimators = n_trees
+
+    def _oob_update(self, tree, X, targets, probe, sample_weight, groups, est, mass):
+        """
+        Add the leaf means of one tree to the running sums est and mass of the probe rows (in place),
+        for the probe rows that are out of bag and fall into a non-empty leaf.
+        """
+        n = len(X)
+        counts = self._sample_counts(tree.random_state, n, sample_weight, groups)
+        leaves = tree.tree_.apply(X)
+        node_weights = sparse.csr_matrix((counts, (leaves, np.arange(n))), shape=(tree.tree_.node_count, n))
+        node_totals = np.asarray(node_weights.sum(axis=1)).ravel()
+        use = node_totals[leaves[probe]] > 0
+        if self.bootstrap:
+            use &= counts[probe] == 0
+        nodes, rows = np.unique(leaves[probe[use]], return_inverse=True)
+        est[use] += (node_weights[nodes].dot(targets) / node_totals[nodes, None])[rows.ravel()]
+        mass[use] += 1
+
+    def _fit_grouped(self, X, y, sample_weight, groups):
+        """
+        Grow the trees as ForestRegressor.fit does, but each on a bootstrap sample of the groups
+        (groups: codes 0, ..., n_groups - 1), passed to the tree as per-row counts.
+        Under warm_start, the fitted trees are kept and only the missing ones are grown.
+        """
+        if not self.bootstrap:
+            raise ValueError("Grouped subsampling draws the groups with replacement, it needs bootstrap=True")
+        self._validate_estimator()
+        random_state = check_random_state(self.random_state)
+        n_old = len(self.estimators_) if self.warm_start and hasattr(self, "estimators_") else 0
+        # draw the seeds of all trees, so that the forest does not depend on how it was grown
+        trees = [self._make_estimator(append=False, random_state=random_state)
+                 for _ in range(self.n_estimators)][n_old:]
+        # as sklearn's _parallel_build_trees: the unchecked _fit, which skips the per-tree input validation
+        # and the n-row leaf arrays that DecisionTreeQuantileRegressor.fit stores (the forest has its own tables)
+        y = np.ascontiguousarray(y, dtype=np.float64)
+        Parallel(n_jobs=self.n_jobs, prefer="threads")(
+            delayed(est._fit)(X, y, check_input=False, sample_weight=np.asarray(
+                self._sample_counts(est.random_state, len(X), sample_weight, groups), dtype=np.float64))
+            for est in trees)
+        self.estimators_ = (self.estimators_[:n_old] if n_old else []) + trees
+        self.n_features_in_ = X.shape[1]
+        self.n_outputs_ = 1 if y.ndim == 1 else y.shape[1]
+
+    def _sample_counts(self, random_state, n, sample_weight=None, groups=None):
+        """
+        In-bag weight of each of the n training rows in the tree seeded by random_state, as used to grow it.
+        """
+        max_samples = self._max_samples(sample_weight)
+        if not self.bootstrap:
+            counts = np.ones(n, dtype=np.int64)
+        elif groups is not None:
+            n_groups = groups.max() + 1
+            counts = np.bincount(generate_sample_indices(random_state, n_groups, self._n_group_draws(n_groups)),
+                                 minlength=n_groups)[groups]
+        elif _WEIGHTED_BOOTSTRAP and sample_weight is not None:
+            # sklearn draws the rows by weight and grows the tree on the plain counts
+            indices = generate_sample_indices(random_state, n, n_samples_bootstrap(n, max_samples, sample_weight),
+                                              sample_weight)
+            return np.bincount(indices, minlength=n)
+        else:
+            counts = np.bincount(generate_sample_indices(random_state, n, n_samples_bootstrap(n, max_samples)),
+                                 minlength=n)
+        if sample_weight is not None:
+            counts = counts * np.asarray(sample_weight, dtype=np.float64)
+        return counts
+
+    def _n_group_draws(self, n_groups):
+        """
+        Number of groups drawn for each tree: n_groups, max_samples (int) or the fraction max_samples of n_groups.
+        """
+        max_samples = getattr(self, "max_samples", None)
+        if max_samples is None:
+            return n_groups
+        if isinstance(max_samples, (int, np.integer)):
+            return max_samples
+        return max(int(max_samples * n_groups), 1)
+
+    def _bootstrap_rate(self, n, sample_weight=None, groups=None):
+        """
+        Expected in-bag count of a training row per unit of its sample weight, under the subsampling of the trees
+        (e.g. max_samples / n); used as the count of the rows added by ``partial_fit``.
+        """
+        if not self.bootstrap:
+            return 1.
+        if groups is not None:
+            n_groups = groups.max() + 1
+            return self._n_group_draws(n_groups) / n_groups
+        if sample_weight is not None and _WEIGHTED_BOOTSTRAP:
+            sample_weight = np.asarray(sample_weight, dtype=np.float64)
+            return n_samples_bootstrap(n, self._max_samples(sample_weight), sample_weight) / sample_weight.sum()
+        return n_samples_bootstrap(n, getattr(self, "max_samples", None)) / n
+
+    def _tree_tables(self, estimators, X, sample_weight=None, groups=None):
+        """
+        Leaf memberships and normalized bootstrap weights of the training rows X in the given trees.
+        The in-bag counts follow the subsampling of the trees (max_samples, groups, see ``_sample_counts``);
+        with sample_weight, they are multiplied by the sample weights, or drawn by weight (sklearn >= 1.6).
+
+        Returns
+        -------
+        y_train_leaves: (n_est, n_samples) leaf of each in-bag row, -1 for out-of-bag rows
+        y_weights: (n_est, n_samples) bootstrap count / sum of counts in the leaf
+        node_counts: (total nodes,) sum of the bootstrap counts in each node, stacked over trees
+        """
+        n = X.shape[0]
+        y_train_leaves = -np.ones((len(estimators), n), dtype=np.int32)
+        y_weights = np.zeros_like(y_train_leaves, dtype=np.float32)
+        node_counts = []
+        for i, est in enumerate(estimators):
+            est_weights = self._sample_counts(est.random_state, n, sample_weight, groups)
+            # sklearn builds the trees on the bootstrap weights; route every training row
+            leaves = est.tree_.apply(X)
+            node_totals = np.bincount(leaves, weights=est_weights, minlength=est.tree_.node_count)
+            y_weights[i] = leaf_normalized_weights(leaves, est_weights, node_totals)
+            y_train_leaves[i] = np.where(est_weights > 0, leaves, -1)
+            node_counts.append(node_totals)
+        return y_train_leaves, y_weights, np.concatenate(node_counts)
+
+    def partial_fit(self, X, y, n_new_trees=0, uv=None, sample_weight=None, groups=None):
+        """
+        Update the fitted forest with new training rows (e.g. newly collected trajectories), without refitting.
+
+        The new rows are routed through the existing trees and join their leaves with their expected in-bag count
+        (bootstrap_rate_ times their sample weight, i.e. one without max_samples and weights), and the leaf
+        weights are renormalized.
+        If n_new_trees > 0, that many trees are grown on the new rows only (sklearn warm start) and appended.
+        The cost is of the order of the increment, not of the whole history.
+
+        Parameters
+        ----------
+        X, y: the new training samples, as in ``fit``
+        n_new_trees: number of trees to grow on the new samples
+        uv: if given, prepare the cos/sin tables for uv; by default the previously prepared uv (if any) is kept
+        sample_weight, groups: of the new samples, as in ``fit`` (the new trees bootstrap the new groups)
+
+        Returns
+        -------
+        self : object
+        """
+        if not hasattr(self, "estimators_"):
+            raise ValueError("partial_fit needs the fitted sklearn trees, which compact() and load() drop")
+        X, y = check_X_y(
+            X, y, accept_sparse="csc", dtype=np.float32, multi_output=1)
+        X = self._bin(X)
+        if uv is None:
+            uv = self.uv_
+        if groups is not None:
+            groups = np.unique(groups, return_inverse=True)[1].ravel()
+        n_old = len(self.y_train_)
+        counts = getattr(self, "bootstrap_rate_", 1.) * (
+            np.ones(len(y)) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64))
+
+        # existing trees: add the new rows to the leaf populations
+        offsets = self.node_offsets_[:-1]
+        nodes = self.apply(X) + offsets  # (n_new, n_tree) stacked node index
+        node_counts = self.node_counts_ + np.bincount(
+            nodes.ravel(), weights=np.repeat(counts, nodes.shape[1]), minlength=len(self.node_counts_))
+        scale = np.divide(self.node_counts_, node_counts, out=np.ones(len(node_counts)), where=node_counts > 0)
+        trees, rows = np.nonzero(self.y_train_leaves_ >= 0)
+        self.y_weights_[trees, rows] *= scale[offsets[trees] + self.y_train_leaves_[trees, rows]]
+        self.y_train_leaves_ = np.hstack([self.y_train_leaves_, (nodes - offsets).T.astype(np.int32)])
+        self.y_weights_ = np.hstack([self.y_weights_, (counts[:, None] / node_counts[nodes]).T.astype(np.float32)])
+        self.node_counts_ = node_counts
+        self.y_train_ = np.concatenate([self.y_train_, y])
+
+        # new trees, grown on the new rows; the old rows are out-of-bag for them
+        if n_new_trees > 0:
+            n_trees = len(self.estimators_)
+            warm_start, self.warm_start = self.warm_start, True
+            self.n_estimators = n_trees + n_new_trees
+            self._grow(X, y, sample_weight, groups)
+            self.warm_start = warm_start
+            leaves, weights, node_counts = self._tree_tables(self.estimators_[n_trees:], X, sample_weight, groups)
+            self.y_train_leaves_ = np.vstack([
+                self.y_train_leaves_, np.hstack([-np.ones((n_new_trees, n_old), dtype=np.int32), leaves])])
+            self.y_weights_ = np.vstack([
+                self.y_weights_, np.hstack([np.zeros((n_new_trees, n_old), dtype=np.float32), weights])])
+            self.node_counts_ = np.concatenate([self.node_counts_, node_counts])
+
+        self._build_leaf_index()
+        self._flatten_trees()
+        if uv is not None:
+            self.prepare(uv)
+        return self
+
+    def _build_leaf_index(self):
+        """
+        Group the training rows by (tree, leaf) once, so that prediction never
+        materializes the N_test * N_train co-membership weights.
+
+        Sets
+        ----
+        node_offsets_: (n_tree + 1,) offsets of each tree's nodes in the stacked node list
+        node_leaf_: (total nodes,) row of the leaf tables for each node; internal nodes
+            (and leaves without bootstrap samples) point to the last, all-zero row
+        leaf_weights_: sparse (n_leaves_total + 1) * n_train matrix, whose row l holds the
+            normalized bootstrap weights y_weights_ of the training rows in leaf l
+        leaf_mass_: (n_leaves_total + 1,) total weight of each leaf (1, or 0 for the last row)
+        """
+        node_counts = [est.tree_.node_count for est in self.estimators_]
+        self.node_offsets_ = np.concatenate([[0], np.cumsum(node_counts)]).astype(np.int64)
+        trees, rows = np.nonzero(self.y_train_leaves_ >= 0)
+        nodes = self.node_offsets_[trees] + self.y_train_leaves_[trees, rows]
+        leaf_nodes, leaf_ids = np.unique(nodes, return_inverse=True)
+        n_leaves = len(leaf_nodes)
+        self.node_leaf_ = np.full(self.node_offsets_[-1], n_leaves, dtype=np.int64)
+        self.node_leaf_[leaf_nodes] = np.arange(n_leaves)
+        self.leaf_weights_ = sparse.csr_matrix(
+            (self.y_weights_[trees, rows].astype(np.float64), (leaf_ids, rows)),
+            shape=(n_leaves + 1, len(self.y_train_)))
+        self.leaf_mass_ = np.asarray(self.leaf_weights_.sum(axis=1)).ravel()
+        self.uv_ = None
+        return self
+
+    def prepare(self, uv):
+        """
+        Store the bootstrap-weighted mean of cos/sin(y * uv) in every leaf, so that
+        predict(X, uv) only needs apply(), a gather and a mean over trees.
+
+        Parameters
+        ----------
+        uv: [B,dim_y]. can be either u or v
+
+        Sets
+        ----
+        leaf_cos_, leaf_sin_: (n_leaves_total + 1) * B tables
+        """
+        uv = np.asarray(uv)
+        temp = self.y_train_.dot(uv.T)
+        self.leaf_cos_ = self.leaf_weights_.dot(np.cos(temp))
+        self.leaf_sin_ = self.leaf_weights_.dot(np.sin(temp))
+        self.uv_ = uv
+        return self
+
+    def _is_prepared(self, uv):
+        return self.uv_ is not None and (uv is self.uv_ or np.array_equal(uv, self.uv_))
+
+    def _tree_mean(self, leaves, leaf_values):
+        """
+        Average the leaf-level values over trees, for (n_samples, n_tree) leaf rows.
+
+        Blocks of test rows are handled by n_jobs threads (numpy's take/add release the GIL).
+        Every row is still summed over trees in the same order, so the result does not depend on n_jobs.
+        """
+        n = leaves.shape[0]
+        est = np.zeros((n, leaf_values.shape[1]))
+        mass = np.zeros(n)
+        n_blocks = max(1, min(effective_n_jobs(self.n_jobs), n // 1000))
+        bounds = np.linspace(0, n, n_blocks + 1).astype(int)
+        Parallel(n_jobs=n_blocks, prefer="threads")(
+            delayed(self._tree_mean_block)(leaves[a:b], leaf_values, est[a:b], mass[a:b])
+            for a, b in zip(bounds[:-1], bounds[1:]))
+        est /= mass[:, None]
+        return est
+
+    def _tree_mean_block(self, leaves, leaf_values, est, mass):
+        """
+        Accumulate the leaf values of one block of rows into est and mass (in place).
+        """
+        buffer = np.empty_like(est)
+        for i in range(leaves.shape[1]): # n_tree
+            np.take(leaf_values, leaves[:, i], axis=0, out=buffer)
+            est += buffer
+            mass += self.leaf_mass_[leaves[:, i]]
+
+    def _flatten_trees(self):
+        """
+        Stack the nodes of all trees into contiguous arrays (the format used by save/load).
+
+        Sets
+        ----
+        tree_feature_, tree_threshold_: (total nodes,) split of each node (0 and 0. for leaves)
+        tree_left_, tree_right_: (total nodes,) stacked index of the children; a leaf points to itself
+        tree_depth_: the maximal depth over trees
+        """
+        offsets = self.node_offsets_
+        nodes = np.arange(offsets[-1])
+        self.tree_feature_ = np.concatenate([est.tree_.feature for est in self.estimators_]).astype(np.int32)
+        self.tree_threshold_ = np.concatenate([est.tree_.threshold for est in self.estimators_])
+        left = np.concatenate([est.tree_.children_left + offsets[i] for i, est in enumerate(self.estimators_)])
+        right = np.concatenate([est.tree_.children_right + offsets[i] for i, est in enumerate(self.estimators_)])
+        is_leaf = np.concatenate([est.tree_.children_left == -1 for est in self.estimators_])
+        self.tree_left_ = np.where(is_leaf, nodes, left)
+        self.tree_right_ = np.where(is_leaf, nodes, right)
+        self.tree_feature_[is_leaf] = 0
+        self.tree_threshold_[is_leaf] = 0.
+        self.tree_depth_ = max(est.tree_.max_depth for est in self.estimators_)
+        return self
+
+    def _apply_flat(self, X):
+        """
+        Route all rows through all trees with the stacked node arrays: every (row, tree) pair moves down
+        one level per vectorized step, and pairs that reached a leaf leave the active set.
+
+        Returns
+        -------
+        (n_samples, n_tree) stacked node index of the leaf reached
+        """
+        X = np.ascontiguousarray(X)
+        n, d = X.shape
+        n_tree = len(self.node_offsets_) - 1
+        is_leaf = self.tree_left_ == np.arange(len(self.tree_left_))
+        node = np.tile(self.node_offsets_[:-1], n)  # (row, tree) pairs, row-major
+        leaves = node.copy()
+        active = np.arange(n * n_tree)
+        row_start = np.repeat(np.arange(n) * d, n_tree)  # position of the row in X.ravel()
+        X = X.ravel()
+        while len(active):
+            go_left = X[row_start + self.tree_feature_[node]] <= self.tree_threshold_[node]
+            node = np.where(go_left, self.tree_left_[node], self.tree_right_[node])
+            done = is_leaf[node]
+            leaves[active[done]] = node[done]
+            active, node, row_start = active[~done], node[~done], row_start[~done]
+        return leaves.reshape(n, n_tree)
+
+    def _leaf_indices(self, X):
+        """
+        Rows of the leaf tables reached by each sample in each tree.
+        Small batches of shallow trees (the typical cross-fitting predictions) and forests without sklearn trees
+        (after ``compact`` or ``load``) are routed with the stacked node arrays; otherwise sklearn's compiled apply.
+
+        Returns
+        -------
+        (n_samples, n_tree) integer array
+        """
+        X = self._bin(X)
+        if not hasattr(self, "estimators_") or X.shape[0] * max(self.tree_depth_, 1) <= _FLAT_APPLY_MAX_WORK:
+            return self.node_leaf_[self._apply_flat(X)]
+        X_leaves = self.apply(X)  # node ids, (n_test, n_tree)
+        return self.node_leaf_[X_leaves + self.node_offsets_[:-1]]
+
+    def compact(self):
+        """
+        Drop the sklearn tree objects and the n_tree * n_train tables (y_train_leaves_, y_weights_), keeping only
+        the stacked node arrays and the leaf tables needed by prepare/predict. This makes a small artifact to
+        pickle into worker processes; the compacted forest can no longer be updated with partial_fit.
+        """
+        for name in ["estimators_", "y_train_leaves_", "y_weights_"]:
+            if hasattr(self, name):
+                delattr(self, name)
+        return self
+
+    def save(self, path):
+        """
+        Write the fitted forest as .npy files (plus a small meta.json) into the directory path.
+        Only the stacked tree arrays and the leaf tables are stored, not the sklearn tree objects.
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = {name: getattr(self, name) for name in _SAVED_ARRAYS if hasattr(self, name)}
+        arrays["leaf_weights_data"] = self.leaf_weights_.data
+        arrays["leaf_weights_indices"] = self.leaf_weights_.indices
+        arrays["leaf_weights_indptr"] = self.leaf_weights_.indptr
+        if self.bin_thresholds_ is not None:
+            arrays["bin_thresholds_"] = self.bin_thresholds_
+        if self.uv_ is not None:
+            arrays.update(uv_=self.uv_, leaf_cos_=self.leaf_cos_, leaf_sin_=self.leaf_sin_)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(array))
+        params = {key: value for key, value in self.get_params(deep=False).items()
+                  if value is None or isinstance(value, (bool, int, float, str))}
+        meta = {"params": params, "tree_depth_": int(self.tree_depth_),
+                "leaf_weights_shape": list(self.leaf_weights_.shape), "arrays": sorted(arrays)}
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Restore a forest written by ``save``. With mmap_mode="r" the arrays are memory-mapped,
+        so several worker processes can share one fitted forest without copying it.
+        The restored forest supports prepare and predict, but not refitting-related sklearn methods (e.g. apply).
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        forest = cls(**meta["params"])
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+                  for name in meta["arrays"]}
+        forest.leaf_weights_ = sparse.csr_matrix(
+            (arrays.pop("leaf_weights_data"), arrays.pop("leaf_weights_indices"),
+             arrays.pop("leaf_weights_indptr")), shape=tuple(meta["leaf_weights_shape"]), copy=False)
+        forest.uv_, forest.bin_thresholds_ = None, None
+        for name, array in arrays.items():
+            setattr(forest, name, array)
+        forest.tree_depth_ = meta["tree_depth_"]
+        return forest
+
+    def predict(self, X, uv=None): # , cos_sin
+        """
+        Predict cond. char. values for either forward or backward
+
+        The weights of a test point are the per-tree leaf co-membership weights summed over trees,
+        so the weighted average equals the average over trees of the leaf-level weighted means.
+        We therefore gather the per-leaf tables from ``prepare`` (built here if uv is new),
+        with cost O(N_test * n_tree * B) instead of O(N_test * N_train).
+        Test rows of this call that fall into the same leaf of every tree (the same leaf signature) get the same
+        estimate, which is computed once per distinct signature.
+
+        Parameters
+        ----------
+        X : array-like or sparse matrix of shape = [n_samples, n_features]
+        uv: [B,dim_y]. can be either u or v. If None, predict E(y|X) (used by CV).
+        Returns
+        -------
+        char_est : array of shape = [n_samples,B]
+        """
+        # apply method requires X to be of dtype np.float32
+        X = check_array(X, dtype=np.float32, accept_sparse="csc") # around N * T
+        leaves = self._leaf_indices(X)
+        _, first, inverse = np.unique(leaf_signatures(leaves), return_index=True, return_inverse=True)
+        leaves = leaves[first]
+        if uv is None: # debug. E(X_t|X_t-1). for CV too.
+            return self._tree_mean(leaves, self.leaf_weights_.dot(self.y_train_))[inverse]
+        if not self._is_prepared(uv):
+            self.prepare(uv)
+        char_est_cos = self._tree_mean(leaves, self.leaf_cos_)[inverse]
+        char_est_sin = self._tree_mean(leaves, self.leaf_sin_)[inverse]
+        return char_est_cos, char_est_sin
+ 
+class RandomForestQuantileRegressor(BaseForestQuantileRegressor):
+    """
+    Based on BaseForestQuantileRegressor. What is the purpose?
+    
+    The sub-sample size is the same as the original input sample size
+    (or max_samples, if given) and the samples are drawn with replacement
+    if `bootstrap=True` (default).
+
+    """
+    def __init__(self,
+                 n_estimators=10,
+                 criterion='squared_error',  # 'mse' deprecated in sklearn 1.3+, use 'squared_error'
+                 max_depth=None,
+                 min_samples_split=2,
+                 min_samples_leaf=1,
+                 min_weight_fraction_leaf=0.0,
+                 max_features='auto',
+                 max_leaf_nodes=None,
+                 bootstrap=True,
+                 oob_score=False,
+                 n_jobs=1,
+                 random_state=None,
+                 verbose=0,
+                 warm_start=False,
+                 max_bins=None,
+                 max_samples=None):
+        self._init_forest(splitter="best", n_estimators=n_estimators, criterion=criterion, max_depth=max_depth,
+            min_samples_split=min_samples_split, min_samples_leaf=min_samples_leaf,
+            min_weight_fraction_leaf=min_weight_fraction_leaf, max_features=max_features,
+            max_leaf_nodes=max_leaf_nodes, bootstrap=bootstrap, oob_score=oob_score, n_jobs=n_jobs,
+            random_state=random_state, verbose=verbose, warm_start=warm_start, max_bins=max_bins,
+            max_samples=max_samples)
+
+class ExtraTreesQuantileRegressor(BaseForestQuantileRegressor):
+    """
+    The quantile forest with extremely randomized trees: each split uses the best of random thresholds
+    (splitter="random") instead of an exhaustive search, which makes growing the trees several times cheaper.
+    The leaf weights and ``predict(X, uv)`` are those of BaseForestQuantileRegressor.
+
+    As in sklearn's ExtraTreesRegressor, `bootstrap=False` by default: every tree uses all the
+    training samples, each with weight one.
+    """
+    def __init__(self,
+                 n_estimators=10,
+                 criterion='squared_error',
+                 max_depth=None,
+                 min_samples_split=2,
+                 min_samples_leaf=1,
+                 min_weight_fraction_leaf=0.0,
+                 max_features='auto',
+                 max_leaf_nodes=None,
+                 bootstrap=False,
+                 oob_score=False,
+                 n_jobs=1,
+                 random_state=None,
+                 verbose=0,
+                 warm_start=False,
+                 max_bins=None,
+                 max_samples=None):
+        self._init_forest(splitter="random", n_estimators=n_estimators, criterion=criterion, max_depth=max_depth,
+            min_samples_split=min_samples_split, min_samples_leaf=min_samples_leaf,
+            min_weight_fraction_leaf=min_weight_fraction_leaf, max_features=max_features,
+            max_leaf_nodes=max_leaf_nodes, bootstrap=bootstrap, oob_score=oob_score, n_jobs=n_jobs,
+            random_state=random_state, verbose=verbose, warm_start=warm_start, max_bins=max_bins,
+            max_samples=max_samples)
 
 class BaseTreeQuantileRegressor(BaseDecisionTree):
     def fit(self, X, y, sample_weight=None, check_input=True,
@@ -298,9 +930,9 @@ class BaseTreeQuantileRegressor(BaseDecisionTree):
         # apply method requires X to be of dtype np.float32
         X, y = check_X_y(
             X, y, accept_sparse="csc", dtype=np.float32, multi_output=1)
+        # X_idx_sorted is kept for backward compatibility only; sklearn >= 1.2 no longer accepts it
         super(BaseTreeQuantileRegressor, self).fit(
-            X, y, sample_weight=sample_weight, check_input=check_input,
-            X_idx_sorted=X_idx_sorted)
+            X, y, sample_weight=sample_weight, check_input=check_input)
         self.y_train_ = y
 
         # Stores the leaf nodes that the samples lie in.
@@ -334,18 +966,23 @@ class BaseTreeQuantileRegressor(BaseDecisionTree):
         X = check_array(X, dtype=np.float32, accept_sparse="csc")
 
         B = u.shape[0]
-        r_cos, r_sin = np.zeros((X.shape[0],B)), np.zeros((X.shape[0],B))
         X_leaves = self.apply(X)
-        unique_leaves = np.unique(X_leaves)
 
-        for leaf in unique_leaves:
-            # for those X_test in that leaf, we use training in that leaf to cal the quantiles.
-            y = self.y_train_[self.y_train_leaves_ == leaf]
-            r_cos[X_leaves == leaf,:] = np.mean(np.cos(y.dot(u.T)),axis = 0)
-            r_sin[X_leaves == leaf,:] = np.mean(np.sin(y.dot(u.T)),axis = 0)
+        # sort the training rows by leaf once, and reduce each segment (leaf) to its mean
+        order = np.argsort(self.y_train_leaves_, kind="stable")
+        sorted_leaves = self.y_train_leaves_[order]
+        starts = np.flatnonzero(np.r_[True, sorted_leaves[1:] != sorted_leaves[:-1]])
+        sizes = np.diff(np.r_[starts, len(order)])[:, None]
+        temp = self.y_train_.reshape(len(self.y_train_), -1)[order].dot(u.T)
+        node_cos, node_sin = np.zeros((self.tree_.node_count, B)), np.zeros((self.tree_.node_count, B))
+        node_cos[sorted_leaves[starts]] = np.add.reduceat(np.cos(temp), starts, axis=0) / sizes
+        node_sin[sorted_leaves[starts]] = np.add.reduceat(np.sin(temp), starts, axis=0) / sizes
+
+        # for those X_test in that leaf, we use training in that leaf to cal the quantiles.
+        r_cos, r_sin = node_cos[X_leaves], node_sin[X_leaves]
         return r_cos, r_sin
 
-class DecisionTreeQuantileRegressor(DecisionTreeRegressor, BaseTreeQuantileRegressor):
+class DecisionTreeQuantileRegressor(BaseTreeQuantileRegressor, DecisionTreeRegressor):
     """
     Just combine QBT and DecisionTreeRegressor, and provide _init_
     
@@ -2,6 +2,7 @@ from ._utility import  *
 from ._uti_basic import  *
 from ._core_test_fun import *
 from ._QRF import  *
+from ._char_est import  *
 # from ._utility_RL import  *
 
 # from ._DGP_Ohio  import  *  
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Alternative (non-forest) estimators of the conditional characteristic functions used in the test of "Does MDP Fit the Data?".
+All of them follow the interface of RandomForestQuantileRegressor: fit(X, y, uv) and predict(X, uv) -> (char_est_cos, char_est_sin).
+"""
+##########################################################################
+import numpy as np
+from scipy import sparse
+from sklearn.base import BaseEstimator, RegressorMixin, clone
+from sklearn.decomposition import PCA
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+from sklearn.kernel_approximation import RBFSampler
+from sklearn.linear_model import Ridge
+from sklearn.neighbors import NearestNeighbors
+from sklearn.utils import check_array, check_X_y
+##########################################################################
+
+def cos_sin_targets(y, uv):
+    """
+    [cos(y * uv), sin(y * uv)], an n * 2B matrix
+    """
+    temp = y.reshape(len(y), -1).dot(uv.T)
+    return np.hstack([np.cos(temp), np.sin(temp)])
+
+##########################################################################
+#%% Random Fourier features + ridge
+
+class RandomFourierCharRegressor(BaseEstimator, RegressorMixin):
+    """
+    Map the predictors to random Fourier features of a Gaussian kernel, and solve one multi-output ridge
+    regression for all the 2B cos/sin targets at once. Both fit and predict are dense GEMMs, linear in the sample size.
+
+    Parameters
+    ----------
+    n_components: number of random Fourier features
+    gamma: bandwidth of the Gaussian kernel exp(-gamma * |x - x'|^2); None means 1 / n_features
+    alpha: ridge penalty
+    random_state: seed of the random features
+    """
+    def __init__(self, n_components=500, gamma=None, alpha=1.0, random_state=0):
+        self.n_components = n_components
+        self.gamma = gamma
+        self.alpha = alpha
+        self.random_state = random_state
+
+    def fit(self, X, y, uv=None):
+        """
+        Parameters
+        ----------
+        X : array-like, shape = [n_samples, n_features]
+        y : array-like, shape = [n_samples] or [n_samples, dim_y]
+        uv: [B,dim_y]. If given, the ridge coefficients for the cos/sin targets are computed here (see ``prepare``).
+        """
+        X, y = check_X_y(X, y, dtype=np.float64, multi_output=1)
+        gamma = 1. / X.shape[1] if self.gamma is None else self.gamma
+        self.features_ = RBFSampler(gamma=gamma, n_components=self.n_components,
+                                    random_state=self.random_state).fit(X)
+        self.X_train_, self.y_train_ = X, y
+        self.uv_ = None
+        if uv is not None:
+            self.prepare(uv)
+        return self
+
+    def prepare(self, uv):
+        """
+        Solve the ridge regression of [cos(y * uv), sin(y * uv)] on the features, for all B directions at once.
+        """
+        uv = np.asarray(uv)
+        self.ridge_ = Ridge(alpha=self.alpha).fit(self.features_.transform(self.X_train_),
+                                                  cos_sin_targets(self.y_train_, uv))
+        self.uv_ = uv
+        return self
+
+    def predict(self, X, uv=None):
+        """
+        Returns
+        -------
+        char_est_cos, char_est_sin: arrays of shape = [n_samples, B]; if uv is None, the ridge fit of y itself
+        """
+        X = check_array(X, dtype=np.float64)
+        Z = self.features_.transform(X)
+        if uv is None:  # E(y|X), e.g. for scoring
+            return Ridge(alpha=self.alpha).fit(self.features_.transform(self.X_train_), self.y_train_).predict(Z)
+        if self.uv_ is None or not (uv is self.uv_ or np.array_equal(uv, self.uv_)):
+            self.prepare(uv)
+        est = self.ridge_.predict(Z)
+        B = uv.shape[0]
+        return est[:, :B], est[:, B:]
+
+##########################################################################
+#%% k-nearest neighbours
+
+class KNNCharRegressor(BaseEstimator, RegressorMixin):
+    """
+    Average cos/sin(y * uv) over the k nearest training predictors, found with a KD-tree / ball-tree.
+    Suited to low-dimensional states, and the only hyperparameter is k.
+
+    Parameters
+    ----------
+    n_neighbors: k
+    algorithm: the spatial index of sklearn.neighbors.NearestNeighbors ("auto", "kd_tree", "ball_tree", "brute")
+    batch_size: number of held-out rows queried at once, which bounds the memory of the neighbour indices
+    n_jobs: number of threads used by each query
+    """
+    def __init__(self, n_neighbors=50, algorithm="auto", batch_size=10000, n_jobs=1):
+        self.n_neighbors = n_neighbors
+        self.algorithm = algorithm
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y, uv=None):
+        X, y = check_X_y(X, y, dtype=np.float64, multi_output=1)
+        self.index_ = NearestNeighbors(n_neighbors=min(self.n_neighbors, len(X)), algorithm=self.algorithm,
+                                       n_jobs=self.n_jobs).fit(X)
+        self.y_train_ = y
+        self.uv_ = None
+        if uv is not None:
+            self.prepare(uv)
+        return self
+
+    def prepare(self, uv):
+        """
+        Store the cos/sin targets of the training rows, n_train * 2B.
+        """
+        uv = np.asarray(uv)
+        self.targets_ = cos_sin_targets(self.y_train_, uv)
+        self.uv_ = uv
+        return self
+
+    def _neighbour_mean(self, X, targets):
+        est = np.zeros((X.shape[0], targets.shape[1]))
+        for start in range(0, X.shape[0], self.batch_size):
+            block = slice(start, start + self.batch_size)
+            neighbours = self.index_.kneighbors(X[block], return_distance=False)  # batch * k
+            for j in range(neighbours.shape[1]):
+                est[block] += targets[neighbours[:, j]]
+        return est / self.index_.n_neighbors
+
+    def predict(self, X, uv=None):
+        """
+        Returns
+        -------
+        char_est_cos, char_est_sin: arrays of shape = [n_samples, B]; if uv is None, the k-NN mean of y itself
+        """
+        X = check_array(X, dtype=np.float64)
+        if uv is None:  # E(y|X), e.g. for scoring
+            return self._neighbour_mean(X, self.y_train_.reshape(len(self.y_train_), -1))
+        if self.uv_ is None or not (uv is self.uv_ or np.array_equal(uv, self.uv_)):
+            self.prepare(uv)
+        est = self._neighbour_mean(X, self.targets_)
+        B = uv.shape[0]
+        return est[:, :B], est[:, B:]
+
+##########################################################################
+#%% exact counting for discrete histories
+
+class CountCharRegressor(BaseEstimator, RegressorMixin):
+    """
+    For discrete predictors (e.g. lag-J histories of the TIGER observations and actions), estimate the conditional
+    characteristic function by the empirical mean of cos/sin(y * uv) among the training rows with exactly the same history.
+    A single counting pass replaces the forest fitting. Histories never seen in training get the marginal mean.
+    """
+    def fit(self, X, y, uv=None):
+        X, y = check_X_y(X, y, dtype=np.float64, multi_output=1)
+        # history -> id, and the number of training rows of each history
+        self.histories_, self.history_ids_, self.counts_ = np.unique(
+            X, axis=0, return_inverse=True, return_counts=True)
+        self.history_ids_ = self.history_ids_.ravel()
+        self.y_train_ = y
+        self.uv_ = None
+        if uv is not None:
+            self.prepare(uv)
+        return self
+
+    def _history_means(self, targets):
+        """
+        (n_histories + 1) * dim table of the mean targets of each history; the last row is the marginal mean.
+        """
+        table = np.zeros((len(self.histories_) + 1, targets.shape[1]))
+        np.add.at(table, self.history_ids_, targets)
+        table[:-1] /= self.counts_[:, None]
+        table[-1] = targets.mean(axis=0)
+        return table
+
+    def prepare(self, uv):
+        """
+        Store the per-history means of cos/sin(y * uv).
+        """
+        uv = np.asarray(uv)
+        self.table_ = self._history_means(cos_sin_targets(self.y_train_, uv))
+        self.uv_ = uv
+        return self
+
+    def _lookup(self, X):
+        """
+        Row of the history table for each sample; unseen histories point to the marginal (last) row.
+        """
+        n_histories = len(self.histories_)
+        _, ids = np.unique(np.vstack([self.histories_, X]), axis=0, return_inverse=True)
+        ids = ids.ravel()
+        position = np.full(ids.max() + 1, n_histories)
+        position[ids[:n_histories]] = np.arange(n_histories)
+        return position[ids[n_histories:]]
+
+    def predict(self, X, uv=None):
+        """
+        Returns
+        -------
+        char_est_cos, char_est_sin: arrays of shape = [n_samples, B]; if uv is None, the per-history mean of y itself
+        """
+        X = check_array(X, dtype=np.float64)
+        rows = self._lookup(X)
+        if uv is None:  # E(y|X), e.g. for scoring
+            return self._history_means(self.y_train_.reshape(len(self.y_train_), -1))[rows]
+        if self.uv_ is None or not (uv is self.uv_ or np.array_equal(uv, self.uv_)):
+            self.prepare(uv)
+        est = self.table_[rows]
+        B = uv.shape[0]
+        return est[:, :B], est[:, B:]
+
+##########################################################################
+#%% class probabilities for discrete targets
+
+class ClassifierCharRegressor(BaseEstimator, RegressorMixin):
+    """
+    For a response with few distinct values y_1, ..., y_K, the conditional characteristic function is
+    sum_k P(y = y_k | X) exp(i * y_k * uv). We fit one probabilistic classifier for the class labels, and evaluate
+    all B directions analytically from the K * 2B table of cos/sin(y_k * uv), so the model cost does not depend on B.
+
+    Parameters
+    ----------
+    classifier: any sklearn classifier with predict_proba; None means a RandomForestClassifier with 100 trees
+    max_classes: fit raises a ValueError if the response takes more distinct values (e.g. a continuous response,
+        for which predict_proba would allocate n_test * n); use a regression estimator such as the QRF instead
+    """
+    def __init__(self, classifier=None, max_classes=100):
+        self.classifier = classifier
+        self.max_classes = max_classes
+
+    def fit(self, X, y, uv=None):
+        X, y = check_X_y(X, y, dtype=np.float64, multi_output=1)
+        self.classes_, labels = np.unique(y.reshape(len(y), -1), axis=0, return_inverse=True)
+        if len(self.classes_) > self.max_classes:
+            raise ValueError("the response takes %d distinct values (more than max_classes = %d); the classifier "
+                             "estimator is meant for discrete responses, use method = 'QRF' instead"
+                             % (len(self.classes_), self.max_classes))
+        classifier = RandomForestClassifier(random_state=0) if self.classifier is None else self.classifier
+        self.classifier_ = clone(classifier).fit(X, labels.ravel())
+        self.uv_ = None
+        if uv is not None:
+            self.prepare(uv)
+        return self
+
+    def prepare(self, uv):
+        """
+        Store the K * 2B table of cos/sin(y_k * uv), for the classes seen by the classifier.
+        """
+        uv = np.asarray(uv)
+        self.table_ = cos_sin_targets(self.classes_[self.classifier_.classes_], uv)
+        self.uv_ = uv
+        return self
+
+    def predict(self, X, uv=None):
+        """
+        Returns
+        -------
+        char_est_cos, char_est_sin: arrays of shape = [n_samples, B]; if uv is None, E(y|X)
+        """
+        X = check_array(X, dtype=np.float64)
+        proba = self.classifier_.predict_proba(X)  # n * K
+        if uv is None:  # E(y|X), e.g. for scoring
+            return proba.dot(self.classes_[self.classifier_.classes_])
+        if self.uv_ is None or not (uv is self.uv_ or np.array_equal(uv, self.uv_)):
+            self.prepare(uv)
+        est = proba.dot(self.table_)
+        B = uv.shape[0]
+        return est[:, :B], est[:, B:]
+
+##########################################################################
+#%% one multi-output forest for all the cos/sin targets
+
+class ForestCharRegressor(BaseEstimator, RegressorMixin):
+    """
+    A single multi-output random forest for the stacked 2B cos/sin targets, so that the cos and sin parts of all
+    B directions share the splits and the trees are grown once (instead of one forest for cos and one for sin).
+    With n_components, the splits are evaluated on the leading principal components of the 2B targets, which is
+    much cheaper for large B; the leaves then store the means of the full targets over their training rows.
+
+    Parameters
+    ----------
+    n_estimators, max_depth, min_samples_leaf, random_state, n_jobs: as in sklearn's RandomForestRegressor
+    n_components: number of principal components of the targets used to grow the trees; None means all 2B targets
+    """
+    def __init__(self, n_estimators=200, max_depth=None, min_samples_leaf=1, n_components=None,
+                 random_state=0, n_jobs=1):
+        self.n_estimators = n_estimators
+        self.max_depth = max_depth
+        self.min_samples_leaf = min_samples_leaf
+        self.n_components = n_components
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+
+    def _forest(self):
+        return RandomForestRegressor(n_estimators=self.n_estimators, max_depth=self.max_depth,
+                                     min_samples_leaf=self.min_samples_leaf, random_state=self.random_state,
+                                     n_jobs=self.n_jobs)
+
+    def fit(self, X, y, uv=None):
+        """
+        Parameters
+        ----------
+        X : array-like, shape = [n_samples, n_features]
+        y : array-like, shape = [n_samples] or [n_samples, dim_y]
+        uv: [B,dim_y]. If given, the forest for the cos/sin targets is grown here (see ``prepare``).
+        """
+        X, y = check_X_y(X, y, dtype=np.float64, multi_output=1)
+        self.X_train_, self.y_train_ = X, y
+        self.uv_ = None
+        if uv is not None:
+            self.prepare(uv)
+        return self
+
+    def prepare(self, uv):
+        """
+        Grow the forest on [cos(y * uv), sin(y * uv)] (or on their principal components), and stack the
+        leaf values of all trees into one (total nodes) * 2B table.
+        """
+        uv = np.asarray(uv)
+        targets = cos_sin_targets(self.y_train_, uv)
+        if self.n_components is None:
+            self.forest_ = self._forest().fit(self.X_train_, targets)
+            tables = [est.tree_.value[:, :, 0] for est in self.forest_.estimators_]
+        else:
+            split_targets = PCA(n_components=min(self.n_components, targets.shape[1]),
+                                random_state=self.random_state).fit_transform(targets)
+            self.forest_ = self._forest().fit(self.X_train_, split_targets)
+            tables = [self._leaf_means(est, targets) for est in self.forest_.estimators_]
+        self.node_offsets_ = np.concatenate([[0], np.cumsum([len(table) for table in tables])])
+        self.table_ = np.vstack(tables)
+        self.uv_ = uv
+        return self
+
+    def _leaf_means(self, est, targets):
+        """
+        Mean targets of the training rows in each node of one tree (internal nodes get zeros; they are never used).
+        """
+        n = len(targets)
+        leaves = est.tree_.apply(self.X_train_.astype(np.float32))
+        members = sparse.csr_matrix((np.ones(n), (leaves, np.arange(n))), shape=(est.tree_.node_count, n))
+        counts = np.bincount(leaves, minlength=est.tree_.node_count)
+        return members.dot(targets) / np.maximum(counts, 1)[:, None]
+
+    def predict(self, X, uv=None):
+        """
+        Returns
+        -------
+        char_est_cos, char_est_sin: arrays of shape = [n_samples, B]; if uv is None, the forest fit of y itself
+        """
+        X = check_array(X, dtype=np.float64)
+        if uv is None:  # E(y|X), e.g. for scoring
+            return self._forest().fit(self.X_train_, self.y_train_).predict(X)
+        if self.uv_ is None or not (uv is self.uv_ or np.array_equal(uv, self.uv_)):
+            self.prepare(uv)
+        nodes = self.forest_.apply(X) + self.node_offsets_[:-1]  # n * n_tree rows of table_
+        est = np.zeros((X.shape[0], self.table_.shape[1]))
+        for j in range(nodes.shape[1]):
+            est += self.table_[nodes[:, j]]
+        est /= nodes.shape[1]
+        B = uv.shape[0]
+        return est[:, :B], est[:, B:]
@@ -7,13 +7,26 @@ Main functions for the test proposed in the paper "Does MDP Fit the Data?". Refe
 ##########################################################################
 #%% 
 from _QRF import *
+from _char_est import *
 from _uti_basic import *
 from _utility import *
+from _grid_search import SuccessiveHalvingSearchCV
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import hashlib
+import json
+import os
+import threading
 ##########################################################################
 # %%
 #n_jobs = multiprocessing.cpu_count()
 n_jobs = 1
 param_grid = {'max_depth': [2, 4, 6, 8], 'min_samples_leaf': [5, 10, 20]}
+RFF_paras = {'n_components': 500, 'gamma': None, 'alpha': 1.0}
+KNN_paras = {'n_neighbors': 50}
+RF_n_components = None  # method = "RF": grow the trees on this many principal components of the 2B targets (None: all)
+CV_search = "grid"  # paras = "CV" / "CV_once": "grid" (exhaustive GridSearchCV) or "halving" (SuccessiveHalvingSearchCV)
+halving_paras = {'resource': 'n_estimators', 'factor': 3, 'min_resources': None}  # about 2.5x cheaper than the grid
 
 ##########################################################################
 #%% Algorithm 1
@@ -22,7 +35,9 @@ def test(data, J = 1,
         paras="CV", n_trees = 200, 
         print_time = False,
         include_reward = False, fixed_state_comp = None, 
-        method = "QRF"):
+        method = "QRF", chunk_rows = None, max_memory = None, dtype = "float64", max_bins = None,
+        compress = False, max_samples = None, sample_trajectories = False, tree_tol = None, forest = "RF",
+        n_fold_jobs = 1, concurrent_directions = False, paras_cache = None):
     """
     The main test function
 
@@ -37,6 +52,28 @@ def test(data, J = 1,
     include_reward: whether or not to include the R_t as part of X_t for our testing
     fixed_state_comp: to resolve the duplicate S problem in the TIGER
     method: the estimators used for the conditional characteristic function estimation.
+        "QRF" (quantile random forests), "RF" (archived), "RFF" (random Fourier features + ridge, see <char_fun_est_RFF>),
+        "KNN" (k-nearest neighbours, see <char_fun_est_KNN>), "COUNT" (exact history counts, for discrete data),
+        "CLF" (class probabilities, for discrete responses; see <char_fun_est_CLF>),
+        or "auto" ("COUNT" if <is_discrete_data>, otherwise "QRF")
+    chunk_rows, max_memory: stream the held-out rows through prediction in blocks of (about) chunk_rows rows,
+        or of a size derived from a byte budget max_memory; see <cond_char_vaule_est>.
+    dtype: "float64" or "float32", the precision of the n * T * B tensors; the Sigma_q Gram matrices are always accumulated in float64.
+    max_bins: if given (<= 256), the forests quantize the predictors into at most max_bins bins once per fold (histogram mode)
+    compress: whether to collapse duplicated (predictor, response) rows before fitting and duplicated test rows before predicting
+    max_samples: if given, each tree of the forests is grown on a subsample of this many rows (int) or this fraction of rows (float)
+    sample_trajectories: draw whole trajectories instead of rows for each tree; max_samples then counts trajectories
+    tree_tol: if given, n_trees is only an upper bound: each forest stops adding trees once its out-of-bag
+        cos/sin estimates change by less than tree_tol (see <char_fun_est>); the trees used are printed per fold
+    forest: the quantile forest of method "QRF": "RF" (random forests) or "ET" (extremely randomized trees,
+        several times cheaper to grow; see ExtraTreesQuantileRegressor)
+    n_fold_jobs: number of processes running the L cross-fitting folds in parallel; each fold uses the module-level
+        n_jobs threads for its forests, so n_fold_jobs * n_jobs should not exceed the number of cores
+    concurrent_directions: fit and predict the forward and backward models of each fold concurrently (two threads,
+        splitting the n_jobs threads of the forests between them)
+    paras_cache: path of a JSON file caching the (max_depth, min_samples_leaf) chosen by paras = "CV" / "CV_once",
+        keyed by the dataset fingerprint, J, L, fold, direction and a hash of the search inputs (the training rows
+        and the search configuration); cached searches are skipped on later calls
     
     Returns
     -------
@@ -48,7 +85,11 @@ def test(data, J = 1,
     a = now()
     lam = lam_est(data = data, J = J, B = B, Q = Q, paras = paras, n_trees = n_trees, 
                   include_reward = include_reward, L = L, 
-                  fixed_state_comp = fixed_state_comp, method = method)
+                  fixed_state_comp = fixed_state_comp, method = method,
+                  chunk_rows = chunk_rows, max_memory = max_memory, dtype = dtype, max_bins = max_bins,
+                  compress = compress, max_samples = max_samples, sample_trajectories = sample_trajectories,
+                  tree_tol = tree_tol, forest = forest, n_fold_jobs = n_fold_jobs,
+                  concurrent_directions = concurrent_directions, paras_cache = paras_cache)
     r, pValues = [], []
     Sigma_q_s = Sigma_q(lam)  # a list (len = Q-1) 2B * 2B.
     if print_time:
@@ -67,15 +108,35 @@ def test(data, J = 1,
 def selectOrder(data, B = 100, Q = 10, L = 3, alpha = 0.01, K = 10, paras="CV", n_trees = 200, 
                         print_time = False,
                         include_reward = False, fixed_state_comp = None, 
-                        method = "QRF"): 
+                        method = "QRF", chunk_rows = None, max_memory = None, dtype = "float64", max_bins = None,
+                        compress = False, max_samples = None, sample_trajectories = False, tree_tol = None,
+                        forest = "RF", n_fold_jobs = 1, concurrent_directions = False, paras_cache = None,
+                        carry_paras = False): 
+    """
+    Test J = 1, ..., K in turn, and stop at the first J that is not rejected at level alpha
+
+    paras_cache: on-disk cache of the CV-chosen hyperparameters, see <test>
+    carry_paras: with paras = "CV" or "CV_once", search the hyperparameters once (forward direction, first fold)
+        at J = 1, and keep them fixed for all J, instead of searching 2 * L times for every J
+    """
     p_values = []
     for k in range(1, K + 1):
+        if carry_paras and paras in ["CV", "CV_once"]:
+            paras = lam_est(data = normalize(data.copy()), J = k, B = B, Q = Q, L = L, paras = "CV_once",
+                            n_trees = n_trees, include_reward = include_reward, fixed_state_comp = fixed_state_comp,
+                            method = method, max_bins = max_bins, max_samples = max_samples, forest = forest,
+                            paras_cache = paras_cache)
+            print("paras for all J:", paras)
         p_value = test(data, J = k,
                         B = B, Q = Q, L = L, 
                         paras=paras, n_trees = n_trees, 
                         print_time = print_time,
                         include_reward = include_reward, fixed_state_comp = fixed_state_comp, 
-                        method = method)
+                        method = method, chunk_rows = chunk_rows, max_memory = max_memory, dtype = dtype,
+                        max_bins = max_bins, compress = compress,
+                        max_samples = max_samples, sample_trajectories = sample_trajectories, tree_tol = tree_tol,
+                        forest = forest, n_fold_jobs = n_fold_jobs, concurrent_directions = concurrent_directions,
+                        paras_cache = paras_cache)
         p_values.append(p_value)
         if p_value > alpha:
             print("Conclude the system is of order:", k)
@@ -142,6 +203,22 @@ def get_pairs( data, is_forward, J = 1, as_array = 1, include_reward = 0, fixed_
     return r
 
 
+def unique_rows(*arrays):
+    """
+    Collapse the identical rows of the (horizontally stacked) arrays
+
+    Returns
+    -------
+    the unique rows split back into the input arrays, their multiplicities, and the index of the unique row of each input row
+    """
+    widths = [a.shape[1] if a.ndim == 2 else 1 for a in arrays]
+    stacked = np.hstack([a.reshape(len(a), -1) for a in arrays])
+    unique, inverse, counts = np.unique(stacked, axis = 0, return_inverse = True, return_counts = True)
+    parts = np.split(unique, np.cumsum(widths)[:-1], axis = 1)
+    parts = [part if a.ndim == 2 else part.ravel() for part, a in zip(parts, arrays)]
+    return parts, counts, inverse.ravel()
+
+
 def get_test_data(test_data, J=1, fixed_state_comp=None):
     """
     Get testing predictors
@@ -170,10 +247,15 @@ def get_test_data(test_data, J=1, fixed_state_comp=None):
 
 # %% Conditional covariance lam construction
 def lam_est(data, J, B, Q, L = 3, 
-            paras = [3, 20], n_trees = 200, include_reward = 0, fixed_state_comp = None, method = "QRF"):
+            paras = [3, 20], n_trees = 200, include_reward = 0, fixed_state_comp = None, method = "QRF",
+            chunk_rows = None, max_memory = None, dtype = "float64", max_bins = None, compress = False,
+            max_samples = None, sample_trajectories = False, tree_tol = None, forest = "RF",
+            n_fold_jobs = 1, concurrent_directions = False, paras_cache = None):
     """
     construct the pointwise cov lam (for both test stat and c.v.), by combine the two parts (estimated and observed)
 
+    dtype: precision of the estimated/observed cos/sin tensors and hence of lam
+
     Returns
     -------
     lam: (Q-1)-len list of four lam matrices (n * T-q * B)
@@ -196,7 +278,11 @@ def lam_est(data, J, B, Q, L = 3,
             paras = paras, n_trees = n_trees, L = L, 
                                     J = J, 
             include_reward = include_reward, fixed_state_comp = fixed_state_comp, 
-                                   method = method)  # ,obs_ys
+                                   method = method, chunk_rows = chunk_rows, max_memory = max_memory, dtype = dtype,
+                                   max_bins = max_bins, compress = compress,
+                                   max_samples = max_samples, sample_trajectories = sample_trajectories,
+                                   tree_tol = tree_tol, forest = forest, n_fold_jobs = n_fold_jobs,
+                                   concurrent_directions = concurrent_directions, paras_cache = paras_cache)
     if paras == "CV_once":
         CV_paras = estimated
         return CV_paras
@@ -205,7 +291,7 @@ def lam_est(data, J, B, Q, L = 3,
         # cos and sin in batch. (n*T*dx) * (dx* B)  = n * T * B:
         # c_X,s_X,c_XA,s_XA
         observed_cond_char = obs_char(data = data, uv = uv, 
-            include_reward = include_reward, fixed_state_comp = fixed_state_comp)
+            include_reward = include_reward, fixed_state_comp = fixed_state_comp, dtype = dtype)
         # combine the above two parts to get cond. corr. estimation.
         lam = lam_formula(estimated_cond_char, observed_cond_char, J, Q)
         return lam
@@ -213,10 +299,29 @@ def lam_est(data, J, B, Q, L = 3,
 
 def cond_char_vaule_est(data, uv,
         paras = "CV_once", n_trees = 200, L = 3, 
-        J = 1, include_reward = 0, fixed_state_comp = None, method = "QRF"):
+        J = 1, include_reward = 0, fixed_state_comp = None, method = "QRF",
+        chunk_rows = None, max_memory = None, dtype = "float64", max_bins = None, compress = False,
+        max_samples = None, sample_trajectories = False, tree_tol = None, forest = "RF", n_fold_jobs = 1,
+        concurrent_directions = False, paras_cache = None):
     """
     Cross-fitting-type prediction of the cond. char "values"
 
+    chunk_rows: if given, the held-out trajectories are predicted in blocks of about chunk_rows rows (N_block * T),
+        and written straight into the output tensors.
+    max_memory: alternatively, a byte budget for the prediction working memory, from which chunk_rows is derived.
+    dtype: precision of the output tensors
+    max_bins: histogram mode of the QRF forests, see <char_fun_est>
+    compress: fit the QRF forests on unique rows with multiplicity weights (see <char_fun_est>), and predict
+        once per unique held-out row, scattering the results back
+    max_samples, sample_trajectories: per-tree subsampling of the QRF forests, see <char_fun_est>
+    tree_tol: adaptive forest size, see <char_fun_est>; the number of trees of the [forward, backward] forests
+        is printed for each fold
+    forest: "RF" or "ET", the quantile forest of method "QRF", see <char_fun_est>
+    n_fold_jobs: number of processes over which the L folds run in parallel (see <cross_fit_parallel>)
+    concurrent_directions: fit and predict the forward and backward directions of each fold in two threads
+    paras_cache: JSON file of CV-chosen hyperparameters; the key of each fold is
+        "<data_fingerprint>/J=<J>/L=<L>/fold=<k>", completed by <char_fun_est>
+
     Returns
     -------
     phi_R, phi_I, psi_R, psi_I values as [n * T * B] tensors.
@@ -225,11 +330,17 @@ def cond_char_vaule_est(data, uv,
     n = N = len(data)
     B = uv[0].shape[0]
     dx, dxa = uv[0].shape[1], uv[1].shape[1]
-    char_values, obs_ys = [np.zeros([n, T, B]) for i in range(4)], [
-        np.zeros([n, T, B]) for i in range(4)]
+    if method == "auto":
+        method = "COUNT" if is_discrete_data(data) else "QRF"
+    char_values = [np.zeros([n, T, B], dtype = dtype) for i in range(4)]
+    if chunk_rows is None and max_memory is not None:
+        chunk_rows = get_chunk_rows(max_memory, B = B, n_trees = n_trees)
+    n_chunk = n if chunk_rows is None else max(1, chunk_rows // T)  # num of trajectories per block
     K = L  # num of cross-fitting
     kf = KFold(n_splits=K)
     kf.get_n_splits(zeros(n))
+    fingerprint = data_fingerprint(data) if paras_cache is not None else None
+    cache_keys = [None if fingerprint is None else "%s/J=%d/L=%d/fold=%d" % (fingerprint, J, K, k) for k in range(K)]
 
     # Just to get CV-based paras
     if paras == "CV_once":
@@ -242,55 +353,186 @@ def cond_char_vaule_est(data, uv,
             train_data, test_data = [data[i] for i in train_index], [data[i] for i in test_index]
             CV_paras = char_fun_est(train_data = train_data,
                 paras = "CV_once", n_trees = n_trees, uv = uv, J = J,
-                include_reward=include_reward, fixed_state_comp=true_state_train)
+                include_reward=include_reward, fixed_state_comp=true_state_train, max_bins = max_bins,
+                max_samples = max_samples, forest = forest, paras_cache = paras_cache, cache_key = cache_keys[0])
             return CV_paras
 
     # estimate char values by cross-fitting
-    for train_index, test_index in kf.split(data):
-        if fixed_state_comp:
-            true_state_train = [fixed_state_comp[i] for i in train_index]
-            true_state_test = [fixed_state_comp[i] for i in test_index]
-        else:
-            true_state_train, true_state_test = None, None
-        train_data, test_data = [data[i] for i in train_index], [data[i] for i in test_index]
-        test_pred = get_test_data(test_data = test_data, J = J, fixed_state_comp = true_state_test)
-        a = now()
-        
-        if method == "QRF":
-            char_funs = char_fun_est(train_data=train_data, paras=paras, n_trees = n_trees, 
-                                     uv=uv, J=J, include_reward=include_reward,
-                                     fixed_state_comp=true_state_train) # a list of four estimated fun
-
-            for i in range(2):  # forward / backward
-                r = char_funs[i].predict(test_pred, uv[i])  # return: char_est_cos, char_est_sin
-                char_values[0 + i][test_index] = r[0].reshape((len(test_index), T, B))
-                char_values[2 + i][test_index] = r[1].reshape((len(test_index), T, B))
-        elif method == "RF":
-            char_funs = char_fun_est_RF(train_data = train_data, 
-                                        paras = paras, n_trees = n_trees, uv = uv, J = J,
-                                       include_reward = include_reward, fixed_state_comp = fixed_state_comp)
-            for i in range(2):
-                r = char_funs[i]
-                char_values[0 + i][test_index] = r[0].predict(test_pred).reshape((len(test_index), T, B))
-                char_values[2 + i][test_index] = r[1].predict(test_pred).reshape((len(test_index), T, B))
+    fold_args = dict(uv = uv, paras = paras, n_trees = n_trees, J = J, include_reward = include_reward,
+                     fixed_state_comp = fixed_state_comp, method = method, n_chunk = n_chunk, max_bins = max_bins,
+                     compress = compress, max_samples = max_samples, sample_trajectories = sample_trajectories,
+                     tree_tol = tree_tol, forest = forest, concurrent_directions = concurrent_directions,
+                     paras_cache = paras_cache)
+    folds = [(train_index, test_index, dict(fold_args, cache_key = cache_keys[k]))
+             for k, (train_index, test_index) in enumerate(kf.split(data))]
+    if n_fold_jobs == 1:
+        for train_index, test_index, args in folds:
+            cross_fit_fold(data, char_values, train_index, test_index, **args)
+    else:
+        char_values = cross_fit_parallel(data, folds, char_values, n_fold_jobs)
     return char_values 
 
 
+def cross_fit_fold(data, char_values, train_index, test_index, uv, paras, n_trees, J, include_reward,
+                   fixed_state_comp, method, n_chunk, max_bins, compress, max_samples, sample_trajectories,
+                   tree_tol, forest, concurrent_directions, paras_cache, cache_key):
+    """
+    One cross-fitting task of <cond_char_vaule_est>: fit the forward and backward estimators on the training
+    trajectories, and write the predictions for the held-out trajectories into char_values (in place).
+    With concurrent_directions, the two directions are fitted (QRF) and predicted (all methods) in two threads.
+    """
+    T = data[0][0].shape[0]
+    B = uv[0].shape[0]
+    if fixed_state_comp:
+        true_state_train = [fixed_state_comp[i] for i in train_index]
+        true_state_test = [fixed_state_comp[i] for i in test_index]
+    else:
+        true_state_train, true_state_test = None, None
+    train_data, test_data = [data[i] for i in train_index], [data[i] for i in test_index]
+    a = now()
+    
+    if method == "QRF":
+        char_funs = char_fun_est(train_data=train_data, paras=paras, n_trees = n_trees, 
+                                 uv=uv, J=J, include_reward=include_reward,
+                                 fixed_state_comp=true_state_train, max_bins = max_bins,
+                                 compress = compress, max_samples = max_samples,
+                                 sample_trajectories = sample_trajectories,
+                                 tree_tol = tree_tol, forest = forest,
+                                 concurrent_directions = concurrent_directions, paras_cache = paras_cache,
+                                 cache_key = cache_key) # a list of four estimated fun
+        if tree_tol is not None:
+            print("trees used:", [len(f.estimators_) for f in char_funs])
+    elif method == "RF":
+        char_funs = char_fun_est_RF(train_data = train_data, 
+                                    paras = paras, n_trees = n_trees, uv = uv, J = J,
+                                    include_reward = include_reward, fixed_state_comp = true_state_train)
+    elif method == "RFF":
+        char_funs = char_fun_est_RFF(train_data = train_data, paras = paras, uv = uv, J = J,
+                                     include_reward = include_reward, fixed_state_comp = true_state_train)
+    elif method == "KNN":
+        char_funs = char_fun_est_KNN(train_data = train_data, paras = paras, uv = uv, J = J,
+                                     include_reward = include_reward, fixed_state_comp = true_state_train)
+    elif method == "COUNT":
+        char_funs = char_fun_est_COUNT(train_data = train_data, uv = uv, J = J,
+                                       include_reward = include_reward, fixed_state_comp = true_state_train)
+    elif method == "CLF":
+        char_funs = char_fun_est_CLF(train_data = train_data, paras = paras, n_trees = n_trees, uv = uv, J = J,
+                                     include_reward = include_reward, fixed_state_comp = true_state_train)
+
+    for start in range(0, len(test_index), n_chunk):  # blocks of held-out trajectories
+        block, end = test_index[start:(start + n_chunk)], start + n_chunk
+        true_state_block = true_state_test[start:end] if true_state_test else None
+        test_pred = get_test_data(test_data = test_data[start:end], J = J, fixed_state_comp = true_state_block)
+        if compress:  # predict once per unique row, then scatter back
+            (test_pred, ), _, inverse = unique_rows(test_pred)
+
+        def predict_direction(i):  # forward / backward
+            r = char_funs[i].predict(test_pred, uv[i])  # return: char_est_cos, char_est_sin
+            if compress:
+                r = [r[0][inverse], r[1][inverse]]
+            char_values[0 + i][block] = r[0].reshape((len(block), T, B))
+            char_values[2 + i][block] = r[1].reshape((len(block), T, B))
+        map_directions(predict_direction, concurrent_directions)
+
+
+def cross_fit_parallel(data, folds, char_values, n_fold_jobs):
+    """
+    Run the folds (train_index, test_index, fold_args) of <cross_fit_fold> in a pool of n_fold_jobs processes.
+
+    The trajectories are stacked (one n * T * dim array for each of X, A (and R)) into shared memory, and the workers
+    write their held-out slices into one shared 4 * n * T * B output tensor, so neither the data nor the
+    estimates are pickled between processes.
+
+    Returns
+    -------
+    the four char_values tensors, copied out of the shared block
+    """
+    blocks, specs = [], []
+    try:
+        for arrays in list(zip(*data)) + [char_values]:  # X's, A's, (R's) and the outputs
+            stacked = np.stack(arrays)
+            shm = shared_memory.SharedMemory(create = True, size = max(stacked.nbytes, 1))
+            blocks.append(shm)
+            np.ndarray(stacked.shape, dtype = stacked.dtype, buffer = shm.buf)[:] = stacked
+            specs.append((shm.name, stacked.shape, stacked.dtype.str))
+        with ProcessPoolExecutor(max_workers = n_fold_jobs) as pool:
+            futures = [pool.submit(_cross_fit_worker, specs, train_index, test_index, fold_args)
+                       for train_index, test_index, fold_args in folds]
+            for future in futures:
+                future.result()
+        out = np.ndarray(specs[-1][1], dtype = specs[-1][2], buffer = blocks[-1].buf)
+        char_values = [out[k].copy() for k in range(4)]
+        del out
+        return char_values
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def _cross_fit_worker(specs, train_index, test_index, fold_args):
+    """
+    Process-pool entry of <cross_fit_parallel>: attach the shared blocks and run one fold on views of them.
+    """
+    blocks = [shared_memory.SharedMemory(name = name) for name, _, _ in specs]
+    arrays = [np.ndarray(shape, dtype = dtype, buffer = shm.buf) for (_, shape, dtype), shm in zip(specs, blocks)]
+    data = [list(traj) for traj in zip(*arrays[:-1])]
+    cross_fit_fold(data, list(arrays[-1]), train_index, test_index, **fold_args)
+    del data, arrays
+    for shm in blocks:
+        shm.close()
+
+
+def get_chunk_rows(max_memory, B, n_trees = 200):
+    """
+    Number of held-out rows that can be predicted at once within max_memory bytes:
+    per row, the leaf indices of all trees (2 int64 arrays) and the cos/sin estimates with their buffers (4 float64 arrays of length B).
+    """
+    bytes_per_row = 16 * n_trees + 32 * B
+    return max(1, int(max_memory // bytes_per_row))
+
+
 def char_fun_est(
         train_data,
-        paras=[3, 20], n_trees = 200, uv = 0, J = 1, include_reward = 0, fixed_state_comp = None):
+        paras=[3, 20], n_trees = 200, uv = 0, J = 1, include_reward = 0, fixed_state_comp = None,
+        warm_start = None, n_new_trees = 0, max_bins = None, compress = False,
+        max_samples = None, sample_trajectories = False, tree_tol = None, forest = "RF",
+        concurrent_directions = False, paras_cache = None, cache_key = None):
     """
     For each cross-fitting-task, use QRF to do prediction
 
     paras == "CV_once": use CV_once to fit
     get_CV_paras == True: just to get paras by using CV
+    warm_start: the [forward, backward] forests returned by an earlier call. Then train_data only contains the newly
+        appended trajectories, which are added to the leaf weight tables, and n_new_trees trees are grown on them.
+    max_bins: if given, each forest quantizes its predictors into at most max_bins bins once, and all its trees
+        search splits over the bin codes (histogram mode) instead of the raw values.
+    compress: collapse identical (predictor, response) rows into unique rows, and fit with their multiplicities as
+        sample weights (the trees are grown as on the repeated rows); the CV search then splits and scores the
+        repeated rows through SuccessiveHalvingSearchCV, exhaustively unless CV_search = "halving"
+    max_samples: if given, each tree is grown on a bootstrap subsample of max_samples rows (int) or of that fraction
+        of the rows (float), which caps the per-tree cost for long trajectory collections
+    sample_trajectories: bootstrap whole training trajectories (all their lag-J pairs) for each tree, instead of rows;
+        max_samples then counts trajectories. Not available with compress, which merges rows across trajectories.
+    tree_tol: if given, each forest is grown in batches of 25 trees, up to n_trees, and stops once a batch changes
+        its out-of-bag cos/sin estimates by less than tree_tol on average (the CV search itself uses n_trees trees)
+    forest: "RF" for RandomForestQuantileRegressor, or "ET" for ExtraTreesQuantileRegressor (random split thresholds,
+        no bootstrap), for both the CV search and the final fits
+    concurrent_directions: fit the forward and backward forests in two threads, each with n_jobs // 2 threads
+    paras_cache, cache_key: JSON file of CV-chosen hyperparameters, and the key of this fold
+        ("<data>/J=<J>/L=<L>/fold=<k>"); the search of each direction is looked up under
+        "<cache_key>/<direction>/<search_key>", where search_key hashes everything the search depends on (the training
+        rows and weights, n_trees, forest, max_bins, max_samples, param_grid and the search method), and only run
+        (and stored) if missing
+    The CV search is exhaustive (GridSearchCV) if the module-level CV_search is "grid", and successive halving over
+    the trees or the trajectories (SuccessiveHalvingSearchCV with halving_paras) if it is "halving".
 
     Returns
     -------
     a list of four estimated fun, and a list of four true y vectors
     """
 
-    char_funs = []
+    QuantileForest = ExtraTreesQuantileRegressor if forest == "ET" else RandomForestQuantileRegressor
 
     X1, y1 = get_pairs(train_data, is_forward = 1, J = J,
                        include_reward = include_reward, fixed_state_comp = fixed_state_comp)
@@ -298,45 +540,230 @@ def char_fun_est(
                        include_reward = include_reward, fixed_state_comp = fixed_state_comp)
 
     X, y = [X1, X2], [y1, y2]
-
-    if paras in ["CV", "CV_once"]:
+    sample_weight = [None, None]
+    # get_pairs stacks the T - J pairs of each trajectory in order
+    trajectories = None if compress else np.repeat(np.arange(len(train_data)),
+                                                   [traj[0].shape[0] - J for traj in train_data])
+    groups = None
+    if sample_trajectories:
+        if compress:
+            raise ValueError("sample_trajectories needs the rows of each trajectory, it can not be used with compress")
+        groups = trajectories
+    if compress:
         for i in range(2):
-            rfqr = RandomForestQuantileRegressor(random_state=0, n_estimators = n_trees)
-            gd = GridSearchCV(estimator = rfqr, param_grid = param_grid, 
-                              cv = 5, n_jobs = n_jobs, verbose=0)
-            gd.fit(X[i], y[i])
-            best_paras = gd.best_params_
-
-            if paras == "CV_once":  # only return forward
+            (X[i], y[i]), sample_weight[i], _ = unique_rows(X[i], y[i])
+
+    if warm_start is not None:
+        return map_directions(lambda i: warm_start[i].partial_fit(
+            X[i], y[i], n_new_trees = n_new_trees, uv = uv[i], sample_weight = sample_weight[i], groups = groups),
+                              concurrent_directions)
+
+    # the module-level n_jobs threads are shared by the two directions when they are fitted concurrently
+    forest_jobs = max(1, n_jobs // 2) if concurrent_directions else n_jobs
+
+    def fit_direction(i):
+        if paras in ["CV", "CV_once"]:
+            key = None if cache_key is None else "%s/%s/%s" % (
+                cache_key, ["forward", "backward"][i], search_key(
+                    X[i], y[i], sample_weight[i], n_trees = n_trees, forest = forest, max_bins = max_bins,
+                    max_samples = max_samples, param_grid = param_grid, CV_search = CV_search,
+                    halving_paras = halving_paras if CV_search == "halving" else None))
+            best_paras = load_paras_cache(paras_cache).get(key) if key is not None else None
+            if best_paras is None:
+                rfqr = QuantileForest(random_state=0, n_estimators = n_trees, max_bins = max_bins,
+                                      max_samples = max_samples)
+                if CV_search == "halving" or compress:
+                    # with compress, GridSearchCV would split and score the unique rows; SuccessiveHalvingSearchCV
+                    # splits the repeated rows, and at min_resources = n_trees it is the exhaustive grid search
+                    search_paras = halving_paras if CV_search == "halving" else {"min_resources": n_trees}
+                    gd = SuccessiveHalvingSearchCV(estimator = rfqr, param_grid = param_grid,
+                                                   cv = 5, n_jobs = forest_jobs, refit = False, **search_paras)
+                    # with resource = "n_samples", whole trajectories are subsampled (not available after compress)
+                    gd.fit(X[i], y[i], sample_weight = sample_weight[i], groups = trajectories)
+                else:
+                    gd = GridSearchCV(estimator = rfqr, param_grid = param_grid, 
+                                      cv = 5, n_jobs = forest_jobs, verbose=0)
+                    gd.fit(X[i], y[i], sample_weight = sample_weight[i])
+                best_paras = gd.best_params_
+                if key is not None:
+                    save_paras_cache(paras_cache, key, best_paras)
+            if paras == "CV_once":
                 return [best_paras['max_depth'], best_paras['min_samples_leaf']]
+            print("best_paras:", best_paras)
+            # use the optimal paras and the whole dataset
+            max_depth, min_samples_leaf = best_paras['max_depth'], best_paras['min_samples_leaf']
+        else:  # pre-specified paras
+            max_depth, min_samples_leaf = paras
+        return QuantileForest(
+            random_state=0, n_estimators = n_trees, 
+            max_depth = max_depth, min_samples_leaf = min_samples_leaf, 
+            n_jobs = forest_jobs, max_bins = max_bins, max_samples = max_samples).fit(
+                X[i], y[i], uv = uv[i], sample_weight = sample_weight[i], groups = groups, tol = tree_tol)
+
+    if paras == "CV_once":  # only return forward
+        return fit_direction(0)
+    return map_directions(fit_direction, concurrent_directions)
+
+
+def map_directions(fun, concurrent_directions = False):
+    """
+    [fun(0), fun(1)] for the forward (0) and backward (1) direction, evaluated in two threads if concurrent_directions
+    (tree building and the numpy prediction kernels release the GIL).
+    """
+    if not concurrent_directions:
+        return [fun(i) for i in range(2)]
+    with ThreadPoolExecutor(max_workers = 2) as pool:
+        return list(pool.map(fun, range(2)))
 
-            elif paras == "CV":
-                print("best_paras:", best_paras)
-                # use the optimal paras and the whole dataset
-                rfqr1 = RandomForestQuantileRegressor(
-                    random_state=0,
-                    n_estimators = n_trees, 
-                    max_depth=best_paras['max_depth'],
-                    min_samples_leaf=best_paras['min_samples_leaf'], 
-                    n_jobs = n_jobs)
-                char_funs.append(rfqr1.fit(X[i], y[i]))
-
-    else:  # pre-specified paras
-        max_depth, min_samples_leaf = paras
-        for i in range(2):
-            char_funs.append(
-                RandomForestQuantileRegressor(
-                    random_state=0, n_estimators = n_trees, 
-                    max_depth = max_depth, min_samples_leaf = min_samples_leaf, 
-                    n_jobs = n_jobs).fit( X[i], y[i]))
 
+def data_fingerprint(data):
+    """
+    sha1 of the (normalized) trajectory arrays, which identifies a dataset in the hyperparameter cache
+    """
+    h = hashlib.sha1()
+    for traj in data:
+        for x in traj:
+            x = np.ascontiguousarray(x)
+            h.update(str(x.shape).encode())
+            h.update(x.tobytes())
+    return h.hexdigest()
+
+
+def search_key(X, y, sample_weight = None, **config):
+    """
+    sha1 of the inputs of one hyperparameter search: its training arrays and its configuration
+    """
+    h = hashlib.sha1(data_fingerprint([[X, y] if sample_weight is None else [X, y, sample_weight]]).encode())
+    h.update(json.dumps(config, sort_keys = True, default = str).encode())
+    return h.hexdigest()
+
+
+_paras_cache_lock = threading.Lock()
+
+def load_paras_cache(path):
+    """
+    {key: {'max_depth': .., 'min_samples_leaf': ..}} stored in the JSON file path (empty if there is none yet)
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_paras_cache(path, key, best_paras):
+    """
+    Add one entry to the JSON hyperparameter cache. The file is replaced atomically, so readers never see a partial
+    file; an entry written by another process in between may be lost, and is then searched again next time.
+    """
+    with _paras_cache_lock:
+        cache = load_paras_cache(path)
+        cache[key] = {k: int(v) for k, v in best_paras.items()}
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(tmp, "w") as f:
+            json.dump(cache, f, indent = 1, sort_keys = True)
+        os.replace(tmp, path)
+
+
+def char_fun_est_RFF(train_data, paras = None, uv = 0, J = 1, include_reward = 0, fixed_state_comp = None):
+    """
+    For each cross-fitting-task, regress the 2B cos/sin targets on random Fourier features of the lag-J predictors
+
+    paras: a dict of RandomFourierCharRegressor parameters (n_components, gamma, alpha); otherwise RFF_paras is used
+
+    Returns
+    -------
+    a list of the forward and backward estimators
+    """
+    if not isinstance(paras, dict):
+        paras = RFF_paras
+    char_funs = []
+    for i, is_forward in enumerate([1, 0]):
+        X, y = get_pairs(train_data, is_forward = is_forward, J = J,
+                         include_reward = include_reward, fixed_state_comp = fixed_state_comp)
+        char_funs.append(RandomFourierCharRegressor(**paras).fit(X, y, uv = uv[i]))
+    return char_funs
+
+
+def char_fun_est_KNN(train_data, paras = None, uv = 0, J = 1, include_reward = 0, fixed_state_comp = None):
+    """
+    For each cross-fitting-task, average the cos/sin targets over the k nearest lag-J training predictors
+
+    paras: a dict of KNNCharRegressor parameters (n_neighbors, algorithm, batch_size), or the integer k;
+        otherwise KNN_paras is used
+
+    Returns
+    -------
+    a list of the forward and backward estimators
+    """
+    if isinstance(paras, int):
+        paras = {'n_neighbors': paras}
+    elif not isinstance(paras, dict):
+        paras = KNN_paras
+    char_funs = []
+    for i, is_forward in enumerate([1, 0]):
+        X, y = get_pairs(train_data, is_forward = is_forward, J = J,
+                         include_reward = include_reward, fixed_state_comp = fixed_state_comp)
+        char_funs.append(KNNCharRegressor(n_jobs = n_jobs, **paras).fit(X, y, uv = uv[i]))
+    return char_funs
+
+
+def char_fun_est_COUNT(train_data, uv = 0, J = 1, include_reward = 0, fixed_state_comp = None):
+    """
+    For each cross-fitting-task, estimate the cond. char. functions from the history -> next-state frequency table
+
+    Returns
+    -------
+    a list of the forward and backward estimators
+    """
+    char_funs = []
+    for i, is_forward in enumerate([1, 0]):
+        X, y = get_pairs(train_data, is_forward = is_forward, J = J,
+                         include_reward = include_reward, fixed_state_comp = fixed_state_comp)
+        char_funs.append(CountCharRegressor().fit(X, y, uv = uv[i]))
+    return char_funs
+
+
+def char_fun_est_CLF(train_data, paras = [3, 20], n_trees = 200, uv = 0, J = 1, include_reward = 0, fixed_state_comp = None):
+    """
+    For each cross-fitting-task with a discrete response (X_{t+J} forward, (X_t, A_t) backward), fit one random forest
+    classifier and evaluate the cond. char. functions analytically from its class probabilities
+
+    paras: [max_depth, min_samples_leaf] of the classifier; other values (e.g. "CV") use the sklearn defaults
+
+    Returns
+    -------
+    a list of the forward and backward estimators
+    """
+    if isinstance(paras, (list, tuple)):
+        max_depth, min_samples_leaf = paras
+    else:
+        max_depth, min_samples_leaf = None, 1
+    char_funs = []
+    for i, is_forward in enumerate([1, 0]):
+        X, y = get_pairs(train_data, is_forward = is_forward, J = J,
+                         include_reward = include_reward, fixed_state_comp = fixed_state_comp)
+        classifier = RandomForestClassifier(random_state = 0, n_estimators = n_trees,
+                                            max_depth = max_depth, min_samples_leaf = min_samples_leaf, n_jobs = n_jobs)
+        char_funs.append(ClassifierCharRegressor(classifier).fit(X, y, uv = uv[i]))
     return char_funs
 
 
-def obs_char(data, uv, include_reward, fixed_state_comp=None):
+def is_discrete_data(data, n_values = 10):
+    """
+    Whether every state/action (and reward) component takes at most n_values distinct values, so that all
+    lag-J histories come from a small finite alphabet (e.g. the TIGER data)
+    """
+    for k in range(len(data[0])):
+        values = np.vstack([a[k] for a in data])
+        if not all(is_disc(values[:, j], n_values) for j in range(values.shape[1])):
+            return False
+    return True
+
+
+def obs_char(data, uv, include_reward, fixed_state_comp=None, dtype="float64"):
     """
     Batchwise calculation for the cos/sin terms, used to define lam
-    (n*T*dx) * (dx* B)  = n * T * B
+    (n*T*dx) * (dx* B)  = n * T * B, in precision dtype
     """
     T = data[0][0].shape[0]
     X_mat = np.array([a[0] for a in data])
@@ -354,7 +781,8 @@ def obs_char(data, uv, include_reward, fixed_state_comp=None):
         S = [X_mat, XA_mat]
     r = []
     for i in range(2):
-        temp = S[i].dot(uv[i].T)
+        # cast the (small) inputs, so that the n * T * B products and cos / sin are computed in dtype
+        temp = S[i].astype(dtype, copy = False).dot(np.asarray(uv[i], dtype = dtype).T)
         r += [cos(temp), sin(temp)]
     return r
 
@@ -422,7 +850,7 @@ def S_hat(lam, dims, J = 1):
 
     Ourputs:
     """
-    Gamma = [np.array([np.mean(a[i], (0, 1)) for a in lam]) for i in range(4)]
+    Gamma = [np.array([np.mean(a[i], (0, 1), dtype = np.float64) for a in lam]) for i in range(4)]
     Gamma_R = Gamma[0] - Gamma[1]  # Gamma_RR - Gamma_II
     Gamma_I = Gamma[2] + Gamma[3]  # Gamma_IR + Gamma_RI
 
@@ -454,8 +882,9 @@ def Sigma_q(Q_four_lams):
         N, T_q, BB = lam.shape
         sigma_q = np.zeros((BB, BB))
         for i in range(N):
-            # aggregate across T with the .dot()
-            sigma_q += lam[i].T.dot(lam[i])
+            # aggregate across T with the .dot(), in float64 even if lam is float32
+            lam_i = lam[i].astype(np.float64, copy = False)
+            sigma_q += lam_i.T.dot(lam_i)
         sigma_q_s_max.append(sigma_q / (N * T_q))
         q += 1
     return sigma_q_s_max
@@ -487,8 +916,11 @@ def bootstrap_p_value(Q_Sigma_q, rep_times, test_stat=0):
 ##########################################################################
 
 def char_fun_est_RF(train_data, paras=[3, 20], n_trees = 200, uv = 0, J = 1,
-                    include_reward = 0, fixed_state_comp = None):
+                    include_reward = 0, fixed_state_comp = None, n_components = None):
     """ cond. char. fun. estimaton with the alternative estimator (multi-outcome random forests)
+
+    One forest per direction for the stacked 2B cos/sin targets (see ForestCharRegressor), so the trees are built once.
+    n_components: grow the trees on this many principal components of the targets; by default RF_n_components
     """
     char_funs = []
     X1, y1 = get_pairs(train_data, is_forward = 1, J = J,
@@ -498,17 +930,12 @@ def char_fun_est_RF(train_data, paras=[3, 20], n_trees = 200, uv = 0, J = 1,
     XX, yy = [X1, X2], [y1, y2]
 
     max_depth, min_samples_leaf = paras
+    if n_components is None:
+        n_components = RF_n_components
     for i in range(2):
-        X, y = XX[i], yy[i]
-        y_cos, y_sin = cos(y.dot(uv[i].T)), sin(y.dot(uv[i].T))
-        regr_cos = RandomForest(random_state = 0, n_estimators = n_trees, 
-                max_depth = max_depth, min_samples_leaf = min_samples_leaf, 
-                n_jobs = n_jobs)
-        regr_sin = RandomForest(random_state = 0, n_estimators = n_trees, 
+        regr = ForestCharRegressor(random_state = 0, n_estimators = n_trees, 
                 max_depth = max_depth, min_samples_leaf = min_samples_leaf, 
-                n_jobs = n_jobs)
-        regr_cos.fit(X, y_cos)
-        regr_sin.fit(X, y_sin)
-        char_funs.append([regr_cos, regr_sin])
+                n_components = n_components, n_jobs = n_jobs)
+        char_funs.append(regr.fit(XX[i], yy[i], uv = uv[i]))
     return char_funs
             
@@ -0,0 +1,20 @@
+"""
+Hyperparameter search for the forests of the characteristic-function estimation.
+
+SuccessiveHalvingSearchCV is defined next to the estimators, in markovtest/testing/_grid_search.py (which only needs
+numpy, scikit-learn and joblib). That module is loaded from its file, so that importing this one does not import the
+testing package and its flat-imported modules.
+"""
+
+import importlib.util
+import os
+
+_spec = importlib.util.spec_from_file_location(
+    __name__ + "._impl",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "markovtest", "testing", "_grid_search.py"))
+_impl = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_impl)
+
+SuccessiveHalvingSearchCV = _impl.SuccessiveHalvingSearchCV
+
+__all__ = ["SuccessiveHalvingSearchCV"]
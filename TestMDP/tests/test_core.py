@@ -0,0 +1,70 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "markovtest", "testing"))
+from _QRF import ExtraTreesQuantileRegressor, RandomForestQuantileRegressor, generate_sample_indices
+
+
+def _loop_leaf_weights(forest, X, n):
+    """Reference: the per-leaf masking loop that fit used before it was vectorized."""
+    y_train_leaves_ = -np.ones((forest.n_estimators, n), dtype=np.int32)
+    y_weights_ = np.zeros_like(y_train_leaves_, dtype=np.float32)
+    for i, est in enumerate(forest.estimators_):
+        bootstrap_indices = generate_sample_indices(est.random_state, n)
+        est_weights = np.bincount(bootstrap_indices, minlength=n)
+        y_train_leaves = est.tree_.apply(X)
+        for curr_leaf in np.unique(y_train_leaves):
+            y_ind = y_train_leaves == curr_leaf
+            y_weights_[i, y_ind] = est_weights[y_ind] / np.sum(est_weights[y_ind])
+        y_train_leaves_[i, bootstrap_indices] = y_train_leaves[bootstrap_indices]
+    return y_train_leaves_, y_weights_
+
+
+def test_vectorized_leaf_weights_match_loop():
+    rng = np.random.RandomState(0)
+    X = rng.randn(400, 3).astype(np.float32)
+    y = X[:, :2] + rng.randn(400, 2) * 0.3
+    forest = RandomForestQuantileRegressor(
+        n_estimators=10, min_samples_leaf=5, random_state=0).fit(X, y)
+
+    y_train_leaves_, y_weights_ = _loop_leaf_weights(forest, X, len(y))
+    np.testing.assert_array_equal(forest.y_train_leaves_, y_train_leaves_)
+    np.testing.assert_allclose(forest.y_weights_, y_weights_, rtol=1e-6)
+    # the weights of each leaf sum to one
+    n_leaves = [len(np.unique(leaves[leaves >= 0])) for leaves in forest.y_train_leaves_]
+    np.testing.assert_allclose(forest.y_weights_.sum(axis=1), n_leaves, rtol=1e-5)
+
+
+def test_weighted_unique_rows_match_duplicated_rows():
+    # discrete data: 1,200 rows with 12 distinct (x, y) pairs, fitted as they are and collapsed with their counts
+    rng = np.random.RandomState(0)
+    X = rng.randint(0, 4, (1200, 1)).astype(np.float32)
+    y = (X + rng.binomial(1, .3, (1200, 1))) % 4
+    rows, counts = np.unique(np.hstack([X, y]), axis=0, return_counts=True)
+    uv = rng.randn(5, 1)
+    grid = np.arange(4, dtype=np.float32)[:, None]
+    for Forest in [RandomForestQuantileRegressor, ExtraTreesQuantileRegressor]:
+        params = dict(n_estimators=50, max_depth=6, min_samples_leaf=20, random_state=0)
+        full = Forest(**params).fit(X, y, uv=uv)
+        collapsed = Forest(**params).fit(rows[:, :1], rows[:, 1:], uv=uv, sample_weight=counts)
+        # the leaf size counts weight: the trees still split on x
+        assert min(est.tree_.max_depth for est in collapsed.estimators_) > 0
+        for a, b in zip(full.predict(grid, uv), collapsed.predict(grid, uv)):
+            np.testing.assert_allclose(a, b, atol=0.05)
+
+
+def test_partial_fit_keeps_history_share():
+    # the appended rows join the leaves with the expected in-bag count of a training row, so two equal batches
+    # keep about half of the leaf weight each, with or without subsampling
+    rng = np.random.RandomState(0)
+    X = rng.randn(4000, 2).astype(np.float32)
+    y = X[:, :1] + rng.randn(4000, 1) * 0.3
+    for max_samples in [None, 200]:
+        forest = RandomForestQuantileRegressor(
+            n_estimators=20, min_samples_leaf=5, max_samples=max_samples, random_state=0).fit(X[:2000], y[:2000])
+        forest.partial_fit(X[2000:], y[2000:])
+        share = forest.y_weights_[:, :2000].sum() / forest.y_weights_.sum()
+        assert 0.45 < share < 0.55
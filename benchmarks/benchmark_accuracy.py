@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Validation benchmark for the float32 compute mode:
+p-value drift of test(..., dtype="float32") relative to the float64 default,
+on lag-1 (null) and lag-2 (alternative) autoregressive trajectories.
+"""
+
+import os, sys
+import numpy as np
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, package_path + "/TestMDP/markovtest/testing")
+from _core_test_fun import *
+
+
+def simu_AR(N = 50, T = 30, lag = 1, seed = 0):
+    """
+    x_t = 0.5 * x_{t-lag} + 0.5 * a_{t-1} + noise, with random binary actions
+    """
+    rng = np.random.RandomState(seed)
+    data = []
+    for i in range(N):
+        X, A = np.zeros((T, 1)), rng.binomial(1, 0.5, (T, 1)).astype(float)
+        X[:lag] = rng.randn(lag, 1)
+        for t in range(lag, T):
+            X[t] = 0.5 * X[t - lag] + 0.5 * A[t - 1] + rng.randn()
+        data.append([X, A])
+    return data
+
+
+def run(rep_times = 10, N = 50, T = 30, B = 50, Q = 5, paras = [6, 10], n_trees = 100):
+    results = []
+    for lag in [1, 2]:
+        for seed in range(rep_times):
+            data = simu_AR(N = N, T = T, lag = lag, seed = seed)
+            p = {}
+            for dtype in ["float64", "float32"]:
+                a = now()
+                p[dtype] = test(data, J = 1, B = B, Q = Q, paras = paras, n_trees = n_trees, dtype = dtype)
+                p[dtype + "_time"] = now() - a
+            results.append([lag, seed, p["float64"], p["float32"],
+                            abs(p["float64"] - p["float32"]), p["float64_time"], p["float32_time"]])
+            print(results[-1])
+    results = pd.DataFrame(results, columns = ["true_lag", "seed", "p_float64", "p_float32",
+                                               "abs_drift", "time_float64", "time_float32"])
+    print(DASH, results.groupby("true_lag")[["abs_drift", "time_float64", "time_float32"]].agg(["mean", "max"]))
+    return results
+
+
+if __name__ == "__main__":
+    results = run()
+    results.to_csv(package_path + "/benchmarks/results/float32_drift.csv", index = False)